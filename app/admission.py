@@ -0,0 +1,74 @@
+import math
+import time
+import asyncio
+from collections import deque
+from metrics import ADMISSION_QUEUE_WAIT, ADMISSION_REJECTED
+
+
+class AdmissionController:
+    """
+    Limits the requests of one class handled at the same time. Up to
+    `max_queue` more wait for a slot in arrival order, at most
+    `queue_timeout` seconds; anything beyond that is rejected right away so
+    the server can answer with a 503 instead of letting latency grow.
+    A `max_in_flight` of 0 admits everything.
+
+    A request can take several slots (its `cost`, e.g. the number of books
+    of a bulk request), at most all of them.
+    """
+    def __init__(self, name, max_in_flight, max_queue=0, queue_timeout=1.0, retry_after=1.0):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.waiters = deque()
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+    def _slots(self, cost):
+        return min(cost, self.max_in_flight) if self.max_in_flight else cost
+
+    def _reject(self, reason):
+        ADMISSION_REJECTED.inc(self.name, reason)
+        return False
+
+    async def acquire(self, cost=1):
+        """Wait for `cost` slots, return False when the request is rejected."""
+        slots = self._slots(cost)
+        if not self.max_in_flight or (self.in_flight + slots <= self.max_in_flight and not self.waiters):
+            self.in_flight += slots
+            ADMISSION_QUEUE_WAIT.observe(0, self.name)
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return self._reject("queue_full")
+
+        started = time.perf_counter()
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append((waiter, slots))
+        try:
+            # Shielded so a timeout leaves the waiter to be checked below
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove((waiter, slots))
+                return self._reject("queue_timeout")
+            # The slot was handed over as the timeout fired
+        ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - started, self.name)
+        return True
+
+    def release(self, cost=1):
+        self.in_flight -= self._slots(cost)
+        # Hand the freed slots to the waiters in arrival order
+        while self.waiters:
+            waiter, slots = self.waiters[0]
+            if not waiter.done():
+                if self.in_flight + slots > self.max_in_flight:
+                    return
+                self.in_flight += slots
+                waiter.set_result(None)
+            self.waiters.popleft()
@@ -1,23 +1,96 @@
+import os
 import uuid
+import base64
+import binascii
 import time
+import asyncio
+import logging
+import argparse
+import multiprocessing
 import tornado.ioloop
 import tornado.web
-import cassandra
-from cassandra.cluster import Cluster
-from tornado.concurrent import run_on_executor
-from concurrent.futures import ThreadPoolExecutor
+import tornado.netutil
+import tornado.process
+from tornado.httpserver import HTTPServer
+from tornado.iostream import StreamClosedError
+from admission import AdmissionController
+from catalog import BookCatalog
+from locks import BookLocks
+from storage import Book, Reservation, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from serialization import ObjectEncoder, RowEncoder, dumps
+from metrics import REGISTRY, REQUEST_DURATION, OPERATION_ERRORS, LOCKS_KEPT, timed
 import json
 from datetime import datetime
 
+log = logging.getLogger(__name__)
+
+
+def encode_cursor(paging_state):
+    if paging_state is None:
+        return None
+    return base64.urlsafe_b64encode(paging_state).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    return base64.urlsafe_b64decode(cursor.encode())
+
+
+# Response encoders of the row types
+BOOKS = RowEncoder(Book._fields)
+RESERVATIONS = RowEncoder(Reservation._fields)
+OBJECTS = ObjectEncoder()
+
+# user_id is a CQL int
+MAX_USER_ID = 2 ** 31 - 1
+
+# Partitions deleted in parallel by /admin/reset at most
+MAX_RESET_CONCURRENCY = 1024
+
+# Reservations written per batch by the bulk operations
+BULK_BATCH_SIZE = 10
+MAX_BULK_BOOKS = 1000
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class LibrarySystem:
-    def __init__(self, contact_points):
-        self.cluster = Cluster(contact_points=contact_points)
-        self.session = self.cluster.connect()
-        self.session.execute("USE library")
-        self.executor = ThreadPoolExecutor(max_workers=4)
-
-    @run_on_executor
-    def make_reservation(self, book_id, user_id):
+    def __init__(self, backend, catalog_ttl=300, page_cache_size=16 * 2 ** 20, allow_reset=False, allow_truncate=False, lock_cache_ttl=1.0):
+        self.backend = backend
+        self.locks = BookLocks(backend, ttl=lock_cache_ttl)
+        self.allow_reset = allow_reset
+        self.allow_truncate = allow_truncate
+        self.catalog = BookCatalog(self.load_books, self.backend.catalog_version, BOOKS.array, ttl=catalog_ttl, max_cached_bytes=page_cache_size)
+        # Set once start has connected and warmed everything up
+        self.ready = False
+
+    async def start(self):
+        """
+        Connect the backend, load the book catalog and encode its first page
+        (what the UI asks for), then mark the system ready.
+        """
+        started = time.perf_counter()
+        await self.backend.start()
+        await self.catalog.load()
+        await self.get_books()
+        self.ready = True
+        log.info("Library system ready in %.2fs", time.perf_counter() - started)
+
+    async def start_with_retries(self, delay=5):
+        # Stay alive (and not ready) while the cluster cannot be reached
+        while True:
+            try:
+                await self.start()
+                return
+            except Exception:
+                log.exception("Failed to start the library system, retrying in %ss", delay)
+                await asyncio.sleep(delay)
+
+    @timed("make_reservation")
+    async def make_reservation(self, book_id, user_id):
         try:
             reservation_id = uuid.uuid4()
 
@@ -28,64 +101,50 @@ class LibrarySystem:
                 return {"error": "Invalid user_id."}
 
             # Attempt to insert into reservation_by_book_id to lock the book
-            query = "INSERT INTO reservation_by_book_id (book_id) VALUES (%s) IF NOT EXISTS"
-            result = self.session.execute(query, (book_id,))
-            if not result.one()[0]:
+            if not await self.locks.acquire(book_id, reservation_id):
                 return {"error": "Book is already reserved."}
 
             # Check if the book exists
-            book = self.session.execute("SELECT * FROM books WHERE book_id = %s", (book_id,)).one()
+            book = await self.backend.get_book(book_id)
             if not book:
                 # Clean up the lock
-                self.session.execute("DELETE FROM reservation_by_book_id WHERE book_id = %s", (book_id,))
+                await self.backend.unlock_book(book_id)
+                self.locks.invalidate(book_id)
                 return {"error": "Book does not exist."}
 
             # Proceed with reservation
             reserved_at = datetime.now()
-            self.session.execute("""
-                INSERT INTO book_reservations (book_id, reservation_id, user_id, reserved_at)
-                VALUES (%s, %s, %s, %s)
-            """, (book_id, reservation_id, user_id, reserved_at))
-
-            self.session.execute("""
-                INSERT INTO reservations (reservation_id, book_id, user_id, reserved_at)
-                VALUES (%s, %s, %s, %s)
-            """, (reservation_id, book_id, user_id, reserved_at))
-
-            self.session.execute("""
-                INSERT INTO user_reservations (user_id, reservation_id, book_id, reserved_at)
-                VALUES (%s, %s, %s, %s)
-            """, (user_id, reservation_id, book_id, reserved_at))
+            await self.backend.add_reservation(reservation_id, book_id, user_id, reserved_at)
 
             # Reservation successful
             return {"message": "Reservation made successfully."}
         except Exception as e:
-            # Log the error or handle it as needed
+            log.exception("Failed to reserve book %s for user %s", book_id, user_id)
+            OPERATION_ERRORS.inc("make_reservation", type(e).__name__)
             return {"error": str(e)}
         
 
-    @run_on_executor
-    def update_reservation(self, book_id, user_id):
+    @timed("update_reservation")
+    async def update_reservation(self, book_id, user_id):
         try:
             user_id = int(user_id)
         except ValueError:
             return {"error": "Invalid user_id."}
         
-        reservation = self.session.execute("SELECT * FROM reservations WHERE user_id = %s AND book_id = %s", (user_id, book_id)).one()
+        reservation = await self.backend.get_reservation(user_id, book_id)
         if not reservation:
             return {"error": "Reservation not found."}
  
         # read necessary data
         reservation_id = reservation.reservation_id
         reserved_at = datetime.now()
-        # update the reservation
-        self.session.execute("UPDATE reservations SET reserved_at = %s WHERE user_id = %s AND book_id = %s", (reserved_at, user_id, book_id))
-        self.session.execute("UPDATE user_reservations SET reserved_at = %s WHERE reservation_id = %s AND user_id = %s", (reserved_at, reservation_id, user_id))
-        self.session.execute("UPDATE book_reservations SET reserved_at = %s WHERE reservation_id = %s AND book_id = %s", (reserved_at, reservation_id, book_id))
+        # update the reservation, unless its lease expired in the meantime
+        if not await self.backend.touch_reservation(reservation_id, book_id, user_id, reserved_at):
+            return {"error": "Reservation has expired."}
         return {"message": "Reservation updated successfully."}
 
-    @run_on_executor
-    def remove_reservation(self, book_id, user_id):
+    @timed("remove_reservation")
+    async def remove_reservation(self, book_id, user_id):
         # Check if user_id is an integer
         try:
             user_id = int(user_id)
@@ -93,104 +152,628 @@ class LibrarySystem:
             return {"error": "Invalid user_id."}
 
         # Check book_reservation if the book is reserved
-        result = self.session.execute("SELECT * FROM book_reservations WHERE book_id = %s", (book_id,))
-        book = result.one() if result else None
+        book = await self.backend.get_book_reservation(book_id)
         if book:
             reservation_id = book.reservation_id
             # Check if the user is the owner of the reservation
             if int(book.user_id) != user_id:
                 return {"error": "User is not the owner of the reservation."}
             
-            # Remove the reservation
-            self.session.execute("DELETE FROM book_reservations WHERE book_id = %s AND reservation_id = %s", (book_id, reservation_id))
-            self.session.execute("DELETE FROM reservations WHERE book_id = %s AND user_id = %s", (book_id, user_id))
-            self.session.execute("DELETE FROM user_reservations WHERE user_id = %s AND reservation_id = %s", (user_id, reservation_id))
-            
-            # Remove the lock
-            self.session.execute("DELETE FROM reservation_by_book_id WHERE book_id = %s", (book_id,))
+            # Remove the reservation together with the lock
+            await self.backend.delete_reservation(reservation_id, book_id, user_id)
+            self.locks.invalidate(book_id)
 
             return {"message": "Reservation removed successfully."}
 
         return {"error": "Reservation not found."}
         
 
-    @run_on_executor
-    def get_books(self):
-        # get 100 books
-        rows = self.session.execute("SELECT * FROM books LIMIT 100")
-        return [{"book_id": str(row.book_id), "title": row.title, "author": row.author, "genre": row.genre, "published_year": row.published_year} for row in rows]
+    @timed("make_reservations")
+    async def make_reservations(self, book_ids, user_id):
+        """
+        Reserve several books for a user. The locks are taken concurrently and
+        the reservations written in batches, the result of every book is
+        returned in the order of `book_ids`.
+        """
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return {"error": "Invalid user_id."}
+
+        book_ids = list(dict.fromkeys(book_ids))
+        results = {}
+
+        def failed(book_id, e):
+            log.error("Failed to reserve book %s for user %s: %r", book_id, user_id, e)
+            OPERATION_ERRORS.inc("make_reservations", type(e).__name__)
+            results[book_id] = {"error": str(e)}
 
-    @run_on_executor
-    def get_reservations(self):
-        rows = self.session.execute("SELECT * FROM reservations")
-        reservations = [{"reservation_id": str(row.reservation_id), "book_id": str(row.book_id), "user_id": row.user_id, "reserved_at": row.reserved_at} for row in rows]
-        return reservations
+        # Attempt to lock every book for its reservation
+        reservation_ids = {book_id: uuid.uuid4() for book_id in book_ids}
+        locked = []
+        outcomes = await asyncio.gather(*(self.locks.acquire(book_id, reservation_ids[book_id]) for book_id in book_ids), return_exceptions=True)
+        for book_id, outcome in zip(book_ids, outcomes):
+            if isinstance(outcome, Exception):
+                failed(book_id, outcome)
+            elif outcome:
+                locked.append(book_id)
+            else:
+                results[book_id] = {"error": "Book is already reserved."}
 
-contact_points = ['cas1', 'cas2', 'cas3']
-library_system = LibrarySystem(contact_points)
+        # Check that the locked books exist
+        reservations = []
+        # Locked books left without a reservation
+        unlock = []
+        reserved_at = datetime.now()
+        books = await asyncio.gather(*(self.backend.get_book(book_id) for book_id in locked), return_exceptions=True)
+        for book_id, book in zip(locked, books):
+            if isinstance(book, Exception):
+                failed(book_id, book)
+                unlock.append(book_id)
+            elif not book:
+                unlock.append(book_id)
+                results[book_id] = {"error": "Book does not exist."}
+            else:
+                reservations.append((reservation_ids[book_id], book_id, user_id, reserved_at))
+
+        # Write the reservations in batches
+        batches = chunks(reservations, BULK_BATCH_SIZE)
+        outcomes = await asyncio.gather(*(self.backend.add_reservations(batch) for batch in batches), return_exceptions=True)
+        for batch, outcome in zip(batches, outcomes):
+            for _, book_id, _, _ in batch:
+                if isinstance(outcome, Exception):
+                    failed(book_id, outcome)
+                else:
+                    results[book_id] = {"message": "Reservation made successfully."}
+            if not isinstance(outcome, Exception):
+                continue
+            if self.backend.write_may_have_applied(outcome):
+                # The reservations may exist, their locks stay until
+                # audit_reservations.py finds them orphaned
+                log.warning("Keeping the locks of %d books whose reservations may have been written", len(batch))
+                LOCKS_KEPT.inc("make_reservations", amount=len(batch))
+            else:
+                unlock.extend(book_id for _, book_id, _, _ in batch)
+
+        # Clean up the locks
+        await asyncio.gather(*(self.backend.unlock_book(book_id) for book_id in unlock), return_exceptions=True)
+        for book_id in unlock:
+            self.locks.invalidate(book_id)
+
+        return {"results": [{"book_id": str(book_id), **results[book_id]} for book_id in book_ids]}
+
+    @timed("remove_reservations")
+    async def remove_reservations(self, book_ids, user_id):
+        """
+        Remove several reservations of a user, returning the result of every
+        book in the order of `book_ids`.
+        """
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return {"error": "Invalid user_id."}
+
+        book_ids = list(dict.fromkeys(book_ids))
+        results = {}
+
+        # Check book_reservations for every book
+        reservations = []
+        books = await asyncio.gather(*(self.backend.get_book_reservation(book_id) for book_id in book_ids), return_exceptions=True)
+        for book_id, book in zip(book_ids, books):
+            if isinstance(book, Exception):
+                OPERATION_ERRORS.inc("remove_reservations", type(book).__name__)
+                results[book_id] = {"error": str(book)}
+            elif not book:
+                results[book_id] = {"error": "Reservation not found."}
+            elif int(book.user_id) != user_id:
+                results[book_id] = {"error": "User is not the owner of the reservation."}
+            else:
+                reservations.append((book.reservation_id, book_id, user_id))
+
+        # Remove the reservations together with their locks in batches
+        batches = chunks(reservations, BULK_BATCH_SIZE)
+        outcomes = await asyncio.gather(*(self.backend.delete_reservations(batch) for batch in batches), return_exceptions=True)
+        for batch, outcome in zip(batches, outcomes):
+            for _, book_id, _ in batch:
+                if isinstance(outcome, Exception):
+                    OPERATION_ERRORS.inc("remove_reservations", type(outcome).__name__)
+                    results[book_id] = {"error": str(outcome)}
+                else:
+                    self.locks.invalidate(book_id)
+                    results[book_id] = {"message": "Reservation removed successfully."}
+
+        return {"results": [{"book_id": str(book_id), **results[book_id]} for book_id in book_ids]}
+
+    async def invalidate_books(self):
+        """
+        Bump the catalog version so every worker on every host reloads its
+        catalog (within its version check interval), this one right away.
+        """
+        await self.backend.bump_catalog_version()
+        self.catalog.invalidate()
+
+    @timed("get_books")
+    async def get_books(self, page=1, limit=100, genre=None, author=None, published_year=None):
+        """
+        Return a page of books served from the in-process catalog, encoded as
+        a JSON array, and the total number of books matching the filters.
+        """
+        return await self.catalog.query(page, limit, genre=genre, author=author, published_year=published_year)
+
+    async def clear_reservations(self, truncate=False, concurrency=64):
+        """
+        Remove every reservation and book lock, yielding progress reports.
+        """
+        if not self.allow_reset:
+            raise PermissionError("Reset is not allowed.")
+        if truncate and not self.allow_truncate:
+            raise PermissionError("Truncation is not allowed.")
+        async for report in self.backend.clear_reservations(truncate, concurrency):
+            self.locks.invalidate()
+            yield report
+
+    async def load_books(self):
+        books = []
+        paging_state = None
+        while True:
+            rows, paging_state = await self.backend.books_page(MAX_PAGE_SIZE, paging_state)
+            books.extend(rows)
+            if paging_state is None:
+                return books
+
+    @timed("get_reservations_page")
+    async def get_reservations_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None, user_id=None):
+        """
+        Return a page of reservation rows, only those of `user_id` when given.
+        """
+        if user_id is None:
+            return await self.backend.reservations_page(page_size, paging_state)
+        return await self.backend.user_reservations_page(user_id, page_size, paging_state)
+
+    async def iter_reservations(self, page_size=DEFAULT_PAGE_SIZE, user_id=None):
+        """
+        Yield every reservation (of `user_id` when given) one page at a time.
+        """
+        paging_state = None
+        while True:
+            reservations, paging_state = await self.get_reservations_page(page_size, paging_state, user_id)
+            yield reservations
+            if paging_state is None:
+                break
+
+def create_backend():
+    """
+    Build the storage backend selected by STORAGE_BACKEND.
+    """
+    backend = os.environ.get("STORAGE_BACKEND", "cassandra")
+    # Seconds before an unrenewed reservation and its lock expire, 0 never
+    lease_ttl = int(os.environ.get("RESERVATION_LEASE_TTL", 0))
+    if backend == "cassandra":
+        from cassandra_config import cluster_from_env, keyspace_from_env
+        from cassandra_storage import CassandraBackend
+        return CassandraBackend(
+            cluster_from_env,
+            keyspace_from_env(),
+            max_in_flight=int(os.environ.get("CASSANDRA_MAX_IN_FLIGHT", 128)),
+            batch_mode=os.environ.get("RESERVATION_BATCH_MODE", "logged"),
+            trace_sample_rate=float(os.environ.get("CASSANDRA_TRACE_SAMPLE_RATE", 0)),
+            lease_ttl=lease_ttl,
+        )
+    if backend == "memory":
+        from memory_storage import MemoryBackend
+        return MemoryBackend.from_csv(
+            os.environ.get("MEMORY_BOOKS_CSV", "books.csv"),
+            latency=float(os.environ.get("MEMORY_LATENCY_MS", 0)) / 1000,
+            lease_ttl=lease_ttl,
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def create_library_system():
+    return LibrarySystem(
+        create_backend(),
+        catalog_ttl=float(os.environ.get("BOOK_CATALOG_TTL", 300)),
+        page_cache_size=int(float(os.environ.get("BOOK_PAGE_CACHE_MB", 16)) * 2 ** 20),
+        allow_reset=os.environ.get("ALLOW_ADMIN_RESET", "").lower() in ("1", "true", "yes"),
+        allow_truncate=os.environ.get("ALLOW_TRUNCATE", "").lower() in ("1", "true", "yes"),
+        lock_cache_ttl=float(os.environ.get("LOCK_CACHE_TTL", 1)),
+    )
+
+class Readiness:
+    """
+    Started flag of every worker, in shared memory created before forking so
+    any worker can tell whether all of them are ready.
+    """
+    def __init__(self, workers):
+        self.started = multiprocessing.Array("b", workers)
+
+    def set(self, worker, started):
+        self.started[worker] = started
+
+    @property
+    def ready(self):
+        return all(self.started)
+
+def create_admission():
+    """
+    Build the admission controllers of the read and write request classes.
+    """
+    queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 1000)) / 1000
+    retry_after = float(os.environ.get("ADMISSION_RETRY_AFTER", 1))
+    return {
+        name: AdmissionController(
+            name,
+            max_in_flight=int(os.environ.get(f"ADMISSION_{name.upper()}_IN_FLIGHT", in_flight)),
+            max_queue=int(os.environ.get(f"ADMISSION_{name.upper()}_QUEUE", queue)),
+            queue_timeout=queue_timeout,
+            retry_after=retry_after,
+        )
+        for name, in_flight, queue in [("read", 256, 512), ("write", 128, 256)]
+    }
 
 class BaseHandler(tornado.web.RequestHandler):
+    # Admission class of the handler, None when it is not limited
+    admission = None
+    # Controller holding the request's slots, set once prepare admitted it
+    admitted = None
+    admitted_cost = 1
+    # Whether the handler needs a started library system
+    requires_ready = True
+
     def set_default_headers(self):
         self.set_header("Content-Type", "application/json")
 
+    @property
+    def library_system(self):
+        return self.settings["library_system"]
+
+    def admission_cost(self):
+        """Number of admission slots the request takes."""
+        return 1
+
+    def write_error(self, status_code, **kwargs):
+        # Errors have the {"error": ...} shape of the API responses, with the
+        # message of an HTTPError raised by the handler
+        message = self._reason
+        error = kwargs.get("exc_info", (None, None))[1]
+        if isinstance(error, tornado.web.HTTPError) and error.log_message:
+            message = error.log_message % error.args if error.args else error.log_message
+        self.finish(json.dumps({"error": message}))
+
+    async def prepare(self):
+        if self.requires_ready and not self.library_system.ready:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish(json.dumps({"error": "Server is starting, retry later."}))
+            return
+        controller = self.settings["admission"].get(self.admission)
+        if controller is None:
+            return
+        cost = self.admission_cost()
+        if not await controller.acquire(cost):
+            self.set_status(503)
+            self.set_header("Retry-After", controller.retry_after_header)
+            self.finish(json.dumps({"error": "Server is overloaded, retry later."}))
+            return
+        self.admitted, self.admitted_cost = controller, cost
+
+    def on_finish(self):
+        if self.admitted is not None:
+            self.admitted.release(self.admitted_cost)
+            self.admitted = None
+        REQUEST_DURATION.observe(self.request.request_time(), type(self).__name__, self.request.method, str(self.get_status()))
+
+    async def stream(self, pages, encoder, ndjson=False):
+        # Flush each page as it arrives instead of buffering the whole response
+        first = True
+        if not ndjson:
+            self.write(b"[")
+        try:
+            async for page in pages:
+                if not page:
+                    continue
+                if ndjson:
+                    self.write(encoder.lines(page))
+                else:
+                    self.write(encoder.items(page) if first else b"," + encoder.items(page))
+                first = False
+                await self.flush()
+        except StreamClosedError:
+            return
+        if not ndjson:
+            self.write(b"]")
+
 class MakeReservationHandler(BaseHandler):
+    admission = "write"
+
     async def post(self):
         data = json.loads(self.request.body)
         book_id = uuid.UUID(data['book_id'])
         user_id = data['user_id']
-        result = await library_system.make_reservation(book_id, user_id)
+        result = await self.library_system.make_reservation(book_id, user_id)
         self.write(json.dumps(result))
 
 class UpdateReservationHandler(BaseHandler):
+    admission = "write"
+
     async def post(self):
         data = json.loads(self.request.body)
         book_id = uuid.UUID(data['book_id'])
         user_id = data['user_id']
-        result = await library_system.update_reservation(book_id, user_id)
+        result = await self.library_system.update_reservation(book_id, user_id)
         self.write(json.dumps(result))
 
 class RemoveReservationHandler(BaseHandler):
+    admission = "write"
+
     async def post(self):
         data = json.loads(self.request.body)
         book_id = uuid.UUID(data['book_id'])
         user_id = data['user_id']
-        result = await library_system.remove_reservation(book_id, user_id)
+        result = await self.library_system.remove_reservation(book_id, user_id)
+        self.write(json.dumps(result))
+
+def bulk_request(handler):
+    """
+    Read the book_ids and user_id of a bulk reservation request.
+    """
+    try:
+        data = json.loads(handler.request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise tornado.web.HTTPError(400, "Expected a JSON object.")
+    if not isinstance(data.get('user_id'), (int, str)):
+        raise tornado.web.HTTPError(400, "Invalid user_id.")
+    book_ids = data.get('book_ids')
+    if not isinstance(book_ids, list) or not 1 <= len(book_ids) <= MAX_BULK_BOOKS:
+        raise tornado.web.HTTPError(400, f"book_ids must be a list of 1 to {MAX_BULK_BOOKS} book ids.")
+    try:
+        book_ids = [uuid.UUID(book_id) for book_id in book_ids]
+    except (TypeError, ValueError, AttributeError):
+        raise tornado.web.HTTPError(400, "Invalid book_id.")
+    return book_ids, data['user_id']
+
+class BulkHandler(BaseHandler):
+    """
+    A bulk request takes a write slot per book, as each book costs a lock
+    or a delete.
+    """
+    admission = "write"
+
+    async def prepare(self):
+        self.book_ids, self.user_id = bulk_request(self)
+        await super().prepare()
+
+    def admission_cost(self):
+        return len(self.book_ids)
+
+class MakeReservationsHandler(BulkHandler):
+    async def post(self):
+        book_ids, user_id = self.book_ids, self.user_id
+        result = await self.library_system.make_reservations(book_ids, user_id)
+        self.write(json.dumps(result))
+
+class RemoveReservationsHandler(BulkHandler):
+    async def post(self):
+        book_ids, user_id = self.book_ids, self.user_id
+        result = await self.library_system.remove_reservations(book_ids, user_id)
         self.write(json.dumps(result))
 
+def books_query(handler):
+    """
+    Read the page, limit and filter arguments of a books request.
+    """
+    try:
+        page = int(handler.get_argument("page", 1))
+        limit = int(handler.get_argument("limit", 100))
+        published_year = handler.get_argument("published_year", None)
+        published_year = int(published_year) if published_year is not None else None
+    except ValueError:
+        raise tornado.web.HTTPError(400, "Invalid page, limit or published_year.")
+    if page < 1 or not 1 <= limit <= 1000:
+        raise tornado.web.HTTPError(400, "Invalid page, limit or published_year.")
+    return {
+        "page": page,
+        "limit": limit,
+        "genre": handler.get_argument("genre", None),
+        "author": handler.get_argument("author", None),
+        "published_year": published_year,
+    }
+
 class GetBooksHandler(BaseHandler):
+    admission = "read"
+
     async def get(self):
-        rows = await library_system.get_books()
-        books = [{"book_id": str(row["book_id"]), "title": row["title"], "author": row["author"], "genre": row["genre"], "published_year": row["published_year"]} for row in rows]
-        self.write(json.dumps(books))
+        books, total = await self.library_system.get_books(**books_query(self))
+        self.set_header("X-Total-Count", str(total))
+        self.write(books)
+
+class InvalidateBooksHandler(BaseHandler):
+    async def post(self):
+        await self.library_system.invalidate_books()
+        self.write(json.dumps({"message": "Book catalog invalidated."}))
 
 
 class GetReservationsHandler(BaseHandler):
-    async def get(self):
-        rows = await library_system.get_reservations()
-        reservations = [{"reservation_id": str(row["reservation_id"]), "book_id": str(row["book_id"]), "user_id": row["user_id"], "reserved_at": str(row["reserved_at"])} for row in rows]
-        self.write(json.dumps(reservations))
+    """
+    Without arguments streams every reservation as a JSON array.
+    `?page_size=N&cursor=C` returns a single page with the cursor of the next one,
+    `?format=ndjson` streams one reservation per line.
+    Under /api/users/<id>/reservations only the reservations of that user are
+    returned, read from its user_reservations partition.
+    """
+    admission = "read"
+
+    async def get(self, user_id=None):
+        if user_id is not None:
+            user_id = int(user_id)
+            if user_id > MAX_USER_ID:
+                raise tornado.web.HTTPError(400, "Invalid user_id.")
+        try:
+            page_size = min(int(self.get_argument("page_size", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            paging_state = decode_cursor(self.get_argument("cursor", None))
+        except (ValueError, binascii.Error):
+            raise tornado.web.HTTPError(400, "Invalid page_size or cursor.")
+        if page_size < 1:
+            raise tornado.web.HTTPError(400, "Invalid page_size or cursor.")
+
+        if self.get_argument("format", "json") == "ndjson":
+            self.set_header("Content-Type", "application/x-ndjson")
+            await self.stream(self.library_system.iter_reservations(page_size, user_id), RESERVATIONS, ndjson=True)
+        elif "page_size" in self.request.arguments or "cursor" in self.request.arguments:
+            rows, paging_state = await self.library_system.get_reservations_page(page_size, paging_state, user_id)
+            self.write(b'{"reservations": ' + RESERVATIONS.array(rows) + b', "next_cursor": ' + dumps(encode_cursor(paging_state)) + b"}")
+        else:
+            await self.stream(self.library_system.iter_reservations(page_size, user_id), RESERVATIONS)
+
+class ResetReservationsHandler(BaseHandler):
+    """
+    Remove every reservation, streaming progress as NDJSON. Disabled unless
+    the server runs with ALLOW_ADMIN_RESET.
+    """
+    async def post(self):
+        if not self.library_system.allow_reset:
+            raise tornado.web.HTTPError(403, "Reset is not allowed.")
+        try:
+            data = json.loads(self.request.body or "{}")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            raise tornado.web.HTTPError(400, "Expected a JSON object.")
+        truncate = bool(data.get("truncate", False))
+        if truncate and not self.library_system.allow_truncate:
+            raise tornado.web.HTTPError(403, "Truncation is not allowed.")
+        concurrency = data.get("concurrency", 64)
+        if type(concurrency) is not int or not 1 <= concurrency <= MAX_RESET_CONCURRENCY:
+            raise tornado.web.HTTPError(400, f"concurrency must be an integer between 1 and {MAX_RESET_CONCURRENCY}.")
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        progress = self.library_system.clear_reservations(truncate, concurrency)
+        await self.stream(([report] async for report in progress), OBJECTS, ndjson=True)
+
+class HealthHandler(BaseHandler):
+    """
+    Liveness: the process is up and serving requests.
+    """
+    requires_ready = False
+
+    def get(self):
+        self.write(json.dumps({"status": "ok"}))
+
+class ReadyHandler(BaseHandler):
+    """
+    Readiness: the backend is connected and the catalog loaded, in every
+    worker when they share a Readiness.
+    """
+    requires_ready = False
+
+    def get(self):
+        readiness = self.settings["readiness"]
+        if not self.library_system.ready or (readiness is not None and not readiness.ready):
+            self.set_status(503)
+            self.write(json.dumps({"status": "starting"}))
+            return
+        self.write(json.dumps({"status": "ready"}))
+
+class MetricsHandler(BaseHandler):
+    requires_ready = False
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(REGISTRY.render())
+
+class IndexHandler(BaseHandler):
+    admission = "read"
+
+    def set_default_headers(self):
+        self.set_header("Content-Type", "text/html; charset=UTF-8")
 
-class IndexHandler(tornado.web.RequestHandler):
     async def get(self):
-        available_books = await library_system.get_books()
+        available_books, _ = await self.library_system.get_books(**books_query(self))
         self.render("index.html", available_books=available_books)
 
 
-def make_app():
+def make_metrics_app(library_system):
+    """
+    Application serving only /metrics, every worker listens on its own port
+    so each scrape reads the counters of a single process.
+    """
+    return tornado.web.Application([
+        (r"/metrics", MetricsHandler),
+    ],
+    library_system=library_system,
+    admission={})
+
+def make_app(library_system, admission=None, readiness=None, debug=False):
     return tornado.web.Application([
         (r"/make_reservation", MakeReservationHandler),
         (r"/update_reservation", UpdateReservationHandler),
         (r"/remove_reservation", RemoveReservationHandler),
+        (r"/make_reservations", MakeReservationsHandler),
+        (r"/remove_reservations", RemoveReservationsHandler),
         (r"/api/books", GetBooksHandler),
+        (r"/api/books/invalidate", InvalidateBooksHandler),
         (r"/api/reservations", GetReservationsHandler),
+        (r"/api/users/(\d+)/reservations", GetReservationsHandler),
+        (r"/admin/reset", ResetReservationsHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/health", HealthHandler),
+        (r"/ready", ReadyHandler),
         (r"/", IndexHandler),
     ],
     template_path="templates",
     static_path="static",
-    debug=True)
+    library_system=library_system,
+    admission=admission or {},
+    readiness=readiness,
+    debug=debug)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run the library reservation server.")
+    parser.add_argument("--port", type=int, default=8888, help="Port to listen on (default: 8888)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVER_WORKERS", 1)),
+                        help="Number of worker processes, 0 for one per CPU (default: SERVER_WORKERS or 1)")
+    parser.add_argument("--reuse_port", action="store_true", default=os.environ.get("SERVER_REUSE_PORT", "").lower() in ("1", "true", "yes"),
+                        help="Let every worker bind its own SO_REUSEPORT socket instead of sharing one")
+    parser.add_argument("--debug", action="store_true", default=os.environ.get("SERVER_DEBUG", "").lower() in ("1", "true", "yes"),
+                        help="Autoreload and no template caching, single process only")
+    parser.add_argument("--metrics_port", type=int, default=int(os.environ.get("SERVER_METRICS_PORT", 9100)),
+                        help="Worker N serves /metrics on this port + N, 0 disables it (default: SERVER_METRICS_PORT or 9100)")
+    args = parser.parse_args()
+    if args.debug and args.workers != 1:
+        parser.error("--debug only works with a single worker")
+    return args
 
 if __name__ == "__main__":
-    app = make_app()
-    app.listen(8888, address="0.0.0.0")
-    print("Server started at http://localhost:8888")
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+
+    # The Cassandra session and its event loop must be created after forking,
+    # each worker gets its own
+    sockets = None
+    if not args.reuse_port:
+        sockets = tornado.netutil.bind_sockets(args.port, address="0.0.0.0")
+    readiness = Readiness(args.workers or tornado.process.cpu_count())
+    if args.workers != 1:
+        tornado.process.fork_processes(args.workers)
+    if args.reuse_port:
+        sockets = tornado.netutil.bind_sockets(args.port, address="0.0.0.0", reuse_port=True)
+
+    # Serve /health right away, /ready and the API once started
+    worker = tornado.process.task_id() or 0
+    # A worker restarted by fork_processes is not ready until it started again
+    readiness.set(worker, False)
+    library_system = create_library_system()
+    app = make_app(library_system, create_admission(), readiness, debug=args.debug)
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    if args.metrics_port:
+        HTTPServer(make_metrics_app(library_system)).listen(args.metrics_port + worker, address="0.0.0.0")
+    print(f"Server started at http://localhost:{args.port} (worker {worker})")
+
+    async def start():
+        await library_system.start_with_retries()
+        readiness.set(worker, True)
+
+    tornado.ioloop.IOLoop.current().spawn_callback(start)
     tornado.ioloop.IOLoop.current().start()
\ No newline at end of file
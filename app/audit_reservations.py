@@ -0,0 +1,254 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cassandra.query import BatchStatement, BatchType
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra_config import cluster_from_env, keyspace_from_env, READ_PROFILE, SCAN_PROFILE
+from statements import QUERIES, StatementRegistry
+from storage import lock_ttl
+
+# Murmur3Partitioner token ring
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+# Token range scans of the reservation tables and point lookups used by the
+# cross checks. Tables sharing a partition key are joined per token range,
+# the lookups check rows across the two partition keys
+AUDIT_QUERIES = {
+    "scan_reservations": """
+        SELECT user_id, book_id, reservation_id, reserved_at FROM reservations
+        WHERE token(user_id) > ? AND token(user_id) <= ?
+    """,
+    "scan_user_reservations": """
+        SELECT user_id, reservation_id, book_id, reserved_at FROM user_reservations
+        WHERE token(user_id) > ? AND token(user_id) <= ?
+    """,
+    "scan_book_reservations": """
+        SELECT book_id, reservation_id, user_id, reserved_at, TTL(reserved_at) FROM book_reservations
+        WHERE token(book_id) > ? AND token(book_id) <= ?
+    """,
+    "scan_locks": "SELECT book_id FROM reservation_by_book_id WHERE token(book_id) > ? AND token(book_id) <= ?",
+    "select_book_reservation_by_id": """
+        SELECT book_id, reservation_id, user_id, reserved_at, TTL(reserved_at) FROM book_reservations
+        WHERE book_id = ? AND reservation_id = ?
+    """,
+    "select_user_reservation": "SELECT reservation_id FROM user_reservations WHERE user_id = ? AND reservation_id = ?",
+    "delete_reservation_if": "DELETE FROM reservations WHERE user_id = ? AND book_id = ? IF reservation_id = ?",
+}
+
+
+def token_ranges(splits):
+    """
+    Split the token ring into `splits` consecutive (start, end] ranges.
+    """
+    size = (MAX_TOKEN - MIN_TOKEN) // splits
+    bounds = [MIN_TOKEN + i * size for i in range(splits)] + [MAX_TOKEN]
+    return list(zip(bounds, bounds[1:]))
+
+
+class Auditor:
+    """
+    Cross checks the four reservation tables one token range at a time.
+    book_reservations is the source of truth: a reservation exists when it
+    has a row there, like remove_reservation assumes.
+
+    Found issues:
+    - double_booking: several book_reservations rows for one book
+    - orphan_lock: a locked book without book_reservations rows
+    - unlocked_reservation: a book_reservations row without the book lock
+    - incomplete_fan_out: a book_reservations row missing from reservations
+      or user_reservations
+    - dangling_reservation: a reservations or user_reservations row without
+      its book_reservations row
+    """
+    def __init__(self, session, statements, page_size=5000, lookup_concurrency=64, repair=False, out=sys.stdout):
+        self.session = session
+        self.statements = statements
+        self.page_size = page_size
+        self.lookup_concurrency = lookup_concurrency
+        self.repair = repair
+        self.out = out
+        self.lock = threading.Lock()
+        self.issues = Counter()
+        self.repaired = Counter()
+        self.rows = Counter()
+
+    def scan(self, name, start, end):
+        statement = self.statements[name].bind((start, end))
+        statement.fetch_size = self.page_size
+        return list(self.session.execute(statement, execution_profile=SCAN_PROFILE))
+
+    def lookup(self, name, parameters):
+        # Returns the first row of every lookup, None when there is none
+        results = execute_concurrent_with_args(
+            self.session, self.statements[name], parameters,
+            concurrency=self.lookup_concurrency, execution_profile=READ_PROFILE)
+        rows = []
+        for success, result in results:
+            if not success:
+                raise result
+            rows.append(result.one())
+        return rows
+
+    def report(self, kind, **details):
+        line = json.dumps({"issue": kind, **details}, default=str)
+        with self.lock:
+            self.issues[kind] += 1
+            self.out.write(line + "\n")
+
+    def repaired_one(self, kind):
+        with self.lock:
+            self.repaired[kind] += 1
+
+    def count(self, table, rows):
+        with self.lock:
+            self.rows[table] += len(rows)
+
+    def audit_books(self, start, end):
+        """
+        Join book_reservations with reservation_by_book_id (both partitioned
+        by book_id) and check that every reservation was written to the tables
+        partitioned by user_id.
+        """
+        reservations = self.scan("scan_book_reservations", start, end)
+        locks = {row[0] for row in self.scan("scan_locks", start, end)}
+        self.count("book_reservations", reservations)
+        self.count("reservation_by_book_id", locks)
+
+        by_book = defaultdict(list)
+        for row in reservations:
+            by_book[row[0]].append(row)
+
+        for book_id, rows in by_book.items():
+            if len(rows) > 1:
+                self.report("double_booking", book_id=book_id, reservations=[row[1] for row in rows])
+            if book_id not in locks:
+                self.report("unlocked_reservation", book_id=book_id, reservation_id=rows[0][1])
+                if self.repair:
+                    # Lock the book for the reservation again, for as long as
+                    # its lease. The lock may have been taken again since the scan
+                    book_id, reservation_id, _, _, ttl = rows[0]
+                    self.session.execute(self.statements["lock_book"], (book_id, reservation_id, lock_ttl(ttl or 0)))
+                    self.repaired_one("unlocked_reservation")
+
+        for book_id in locks - by_book.keys():
+            self.report("orphan_lock", book_id=book_id)
+            if self.repair:
+                # The lock may belong to a reservation being made right now
+                if self.session.execute(self.statements["select_book_reservation"], (book_id,)).one() is None:
+                    self.session.execute(self.statements["unlock_book"], (book_id,))
+                    self.repaired_one("orphan_lock")
+
+        user_rows = self.lookup("select_reservation", [(row[2], row[0]) for row in reservations])
+        user_index_rows = self.lookup("select_user_reservation", [(row[2], row[1]) for row in reservations])
+        for row, user_row, user_index_row in zip(reservations, user_rows, user_index_rows):
+            book_id, reservation_id, user_id, reserved_at, ttl = row
+            has_reservation = user_row is not None and user_row.reservation_id == reservation_id
+            # When one of the two rows exists audit_users reports the reservation
+            if has_reservation or user_index_row is not None:
+                continue
+            self.report("incomplete_fan_out", book_id=book_id, reservation_id=reservation_id, user_id=user_id)
+            if self.repair:
+                self.rewrite(row)
+
+    def audit_users(self, start, end):
+        """
+        Join reservations with user_reservations (both partitioned by user_id)
+        and check every reservation against book_reservations.
+        """
+        reservations = self.scan("scan_reservations", start, end)
+        user_reservations = self.scan("scan_user_reservations", start, end)
+        self.count("reservations", reservations)
+        self.count("user_reservations", user_reservations)
+
+        # (user_id, book_id, reservation_id) -> [in reservations, in user_reservations]
+        found = defaultdict(lambda: [False, False])
+        for user_id, book_id, reservation_id, _ in reservations:
+            found[(user_id, book_id, reservation_id)][0] = True
+        for user_id, reservation_id, book_id, _ in user_reservations:
+            found[(user_id, book_id, reservation_id)][1] = True
+
+        keys = list(found)
+        book_rows = self.lookup("select_book_reservation_by_id", [(book_id, reservation_id) for _, book_id, reservation_id in keys])
+        for (user_id, book_id, reservation_id), book_row in zip(keys, book_rows):
+            in_reservations, in_user_reservations = found[(user_id, book_id, reservation_id)]
+            if book_row is None:
+                self.report("dangling_reservation", book_id=book_id, reservation_id=reservation_id, user_id=user_id)
+                if self.repair:
+                    # Only delete the reservations row if it still is this reservation
+                    self.session.execute(self.statements["delete_reservation_if"], (user_id, book_id, reservation_id))
+                    self.session.execute(self.statements["delete_user_reservation"], (user_id, reservation_id))
+                    self.repaired_one("dangling_reservation")
+            elif not (in_reservations and in_user_reservations):
+                self.report("incomplete_fan_out", book_id=book_id, reservation_id=reservation_id, user_id=user_id)
+                if self.repair:
+                    self.rewrite(tuple(book_row))
+
+    def rewrite(self, book_row):
+        """
+        Write a reservation to all three tables from its book_reservations row.
+        """
+        book_id, reservation_id, user_id, reserved_at, ttl = book_row
+        ttl = ttl or 0
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
+        batch.add(self.statements["insert_book_reservation"], (book_id, reservation_id, user_id, reserved_at, ttl))
+        batch.add(self.statements["insert_reservation"], (reservation_id, book_id, user_id, reserved_at, ttl))
+        batch.add(self.statements["insert_user_reservation"], (user_id, reservation_id, book_id, reserved_at, ttl))
+        self.session.execute(batch)
+        self.repaired_one("incomplete_fan_out")
+
+    def run(self, splits=1024, concurrency=16):
+        """
+        Audit every token range, `concurrency` of them at a time. Issues are
+        written as JSON lines to `out` as they are found.
+        """
+        started = time.monotonic()
+        jobs = [(audit, start, end) for start, end in token_ranges(splits) for audit in (self.audit_books, self.audit_users)]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(audit, start, end): (audit.__name__, start, end) for audit, start, end in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Failed {futures[future]}: {e!r}", file=sys.stderr)
+                if done % 100 == 0 or done == len(jobs):
+                    print(f"{done}/{len(jobs)} ranges audited in {time.monotonic() - started:.1f}s", file=sys.stderr)
+        return {
+            "rows": dict(self.rows),
+            "issues": dict(self.issues),
+            "repaired": dict(self.repaired),
+            "failed_ranges": failed,
+            "duration_s": time.monotonic() - started,
+        }
+
+
+def main(splits=1024, concurrency=16, lookup_concurrency=64, page_size=5000, repair=False):
+    cluster = cluster_from_env()
+    session = cluster.connect(keyspace_from_env())
+    statements = StatementRegistry(session, dict(QUERIES, **AUDIT_QUERIES))
+    try:
+        auditor = Auditor(session, statements, page_size, lookup_concurrency, repair)
+        summary = auditor.run(splits, concurrency)
+    finally:
+        cluster.shutdown()
+    print(json.dumps(summary), file=sys.stderr)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the reservation tables agree with each other.")
+    parser.add_argument("--splits", type=int, default=1024, help="Number of token ranges the ring is split into (default: 1024)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of token ranges audited in parallel (default: 16)")
+    parser.add_argument("--lookup_concurrency", type=int, default=64, help="Number of concurrent point lookups per range (default: 64)")
+    parser.add_argument("--page_size", type=int, default=5000, help="Rows fetched per page of a range scan (default: 5000)")
+    parser.add_argument("--repair", action="store_true", help="Fix orphan locks, unlocked reservations and partially written or deleted reservations. Double bookings are only reported.")
+    args = parser.parse_args()
+
+    summary = main(args.splits, args.concurrency, args.lookup_concurrency, args.page_size, args.repair)
+    sys.exit(1 if summary["issues"] or summary["failed_ranges"] else 0)
@@ -0,0 +1,85 @@
+import os
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy, ConstantSpeculativeExecutionPolicy
+from cassandra.query import tuple_factory
+
+# Execution profiles, the default one is used for writes
+READ_PROFILE = "read"  # point reads of reservations
+CATALOG_PROFILE = "catalog"  # books and the catalog version, tuple rows
+SCAN_PROFILE = "scan"  # paged scans of the reservation tables, tuple rows
+LOCK_PROFILE = "lock"  # the lightweight transaction taking a book lock
+
+DEFAULT_CONTACT_POINTS = ["cas1", "cas2", "cas3"]
+
+
+def consistency_level(name):
+    try:
+        return ConsistencyLevel.name_to_value[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown consistency level: {name}")
+
+
+def execution_profiles(local_dc=None, read_consistency="LOCAL_QUORUM", catalog_consistency="LOCAL_ONE",
+                       write_consistency="LOCAL_QUORUM", serial_consistency="LOCAL_SERIAL",
+                       request_timeout=10.0, speculative_delay=0.05, speculative_attempts=2):
+    """
+    Build the execution profiles of the library. Requests are routed to a
+    replica of their partition in the local datacenter (the one of the
+    contact points when `local_dc` is not given). Reads are retried on
+    another replica after `speculative_delay` seconds, up to
+    `speculative_attempts` more times (0 disables it); the driver only does
+    so for statements marked idempotent.
+    """
+    def profile(consistency, row_factory=None, speculative=False, **options):
+        if row_factory is not None:
+            options["row_factory"] = row_factory
+        if speculative and speculative_delay and speculative_attempts:
+            options["speculative_execution_policy"] = ConstantSpeculativeExecutionPolicy(speculative_delay, speculative_attempts)
+        return ExecutionProfile(
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=local_dc)),
+            consistency_level=consistency_level(consistency),
+            request_timeout=request_timeout,
+            **options
+        )
+
+    return {
+        EXEC_PROFILE_DEFAULT: profile(write_consistency),
+        READ_PROFILE: profile(read_consistency, speculative=True),
+        CATALOG_PROFILE: profile(catalog_consistency, tuple_factory, speculative=True),
+        SCAN_PROFILE: profile(read_consistency, tuple_factory, speculative=True),
+        LOCK_PROFILE: profile(write_consistency, serial_consistency_level=consistency_level(serial_consistency)),
+    }
+
+
+def contact_points_from_env():
+    """
+    CASSANDRA_CONTACT_POINTS is a comma-separated list of hosts,
+    CASSANDRA_IP_ADDRESS a single one.
+    """
+    contact_points = os.environ.get("CASSANDRA_CONTACT_POINTS") or os.environ.get("CASSANDRA_IP_ADDRESS")
+    if not contact_points:
+        return list(DEFAULT_CONTACT_POINTS)
+    return [host.strip() for host in contact_points.split(",") if host.strip()]
+
+
+def keyspace_from_env():
+    return os.environ.get("CASSANDRA_KEYSPACE", "library")
+
+
+def cluster_from_env():
+    """
+    Build a (not yet connected) Cluster configured by the CASSANDRA_*
+    environment variables.
+    """
+    profiles = execution_profiles(
+        local_dc=os.environ.get("CASSANDRA_LOCAL_DC") or None,
+        read_consistency=os.environ.get("CASSANDRA_READ_CONSISTENCY", "LOCAL_QUORUM"),
+        catalog_consistency=os.environ.get("CASSANDRA_CATALOG_CONSISTENCY", "LOCAL_ONE"),
+        write_consistency=os.environ.get("CASSANDRA_WRITE_CONSISTENCY", "LOCAL_QUORUM"),
+        serial_consistency=os.environ.get("CASSANDRA_SERIAL_CONSISTENCY", "LOCAL_SERIAL"),
+        request_timeout=float(os.environ.get("CASSANDRA_REQUEST_TIMEOUT", 10)),
+        speculative_delay=float(os.environ.get("CASSANDRA_SPECULATIVE_DELAY_MS", 50)) / 1000,
+        speculative_attempts=int(os.environ.get("CASSANDRA_SPECULATIVE_ATTEMPTS", 2)),
+    )
+    return Cluster(contact_points=contact_points_from_env(), execution_profiles=profiles)
@@ -0,0 +1,353 @@
+import time
+import random
+import asyncio
+import logging
+from cassandra import WriteTimeout, OperationTimedOut
+from cassandra.cluster import EXEC_PROFILE_DEFAULT
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
+from cassandra_config import READ_PROFILE, CATALOG_PROFILE, SCAN_PROFILE, LOCK_PROFILE
+from statements import StatementRegistry
+from storage import StorageBackend, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, lock_ttl
+from metrics import QUERY_DURATION, QUERY_ERRORS
+
+log = logging.getLogger(__name__)
+
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _reject(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+def _trace_options(on_trace, options):
+    if on_trace is not None:
+        options["trace"] = True
+    return options
+
+
+def execute_async(session, query, parameters=None, timeout=None, on_trace=None, execution_profile=EXEC_PROFILE_DEFAULT, host=None):
+    """
+    Run `query` with the driver's execute_async and return an asyncio future
+    resolving to the list of all rows (every page is fetched).
+    When `on_trace` is given the request is traced and `on_trace` is called
+    with the driver's response future in the loop's default executor.
+    `host` sends the request to that node, bypassing load balancing.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    options = {"execution_profile": execution_profile}
+    if timeout is not None:
+        options["timeout"] = timeout
+    if host is not None:
+        options["host"] = host
+    options = _trace_options(on_trace, options)
+    response_future = session.execute_async(query, parameters, **options)
+    rows = []
+
+    # Driver callbacks run on its event thread, hand results back to the loop
+    def on_success(page):
+        rows.extend(page)
+        if response_future.has_more_pages:
+            response_future.start_fetching_next_page()
+        else:
+            loop.call_soon_threadsafe(_resolve, future, rows)
+            if on_trace is not None:
+                loop.call_soon_threadsafe(loop.run_in_executor, None, on_trace, response_future)
+
+    def on_error(exc):
+        loop.call_soon_threadsafe(_reject, future, exc)
+
+    response_future.add_callbacks(on_success, on_error)
+    return future
+
+
+def fetch_page(session, statement, paging_state=None, on_trace=None, execution_profile=EXEC_PROFILE_DEFAULT):
+    """
+    Run `statement` and return an asyncio future resolving to the rows of a
+    single page and the paging state of the next one (None on the last page).
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    options = _trace_options(on_trace, {"paging_state": paging_state, "execution_profile": execution_profile})
+    response_future = session.execute_async(statement, **options)
+
+    def on_success(page):
+        next_paging_state = response_future.result().paging_state if response_future.has_more_pages else None
+        loop.call_soon_threadsafe(_resolve, future, (page, next_paging_state))
+        if on_trace is not None:
+            loop.call_soon_threadsafe(loop.run_in_executor, None, on_trace, response_future)
+
+    def on_error(exc):
+        loop.call_soon_threadsafe(_reject, future, exc)
+
+    response_future.add_callbacks(on_success, on_error)
+    return future
+
+
+# How the denormalized reservation writes are grouped, "none" sends them
+# as separate concurrent requests
+BATCH_TYPES = {"logged": BatchType.LOGGED, "unlogged": BatchType.UNLOGGED, "none": None}
+
+# Partitions holding reservation data, as (table, key query, partition deletes)
+USER_PARTITION_DELETES = ("delete_user_reservations_partition", "delete_user_user_reservations_partition")
+BOOK_PARTITION_DELETES = ("delete_book_reservations_partition", "unlock_book")
+RESERVATION_PARTITIONS = [
+    ("reservations", "select_reservation_users", USER_PARTITION_DELETES),
+    ("user_reservations", "select_user_reservation_users", USER_PARTITION_DELETES),
+    ("book_reservations", "select_book_reservation_books", BOOK_PARTITION_DELETES),
+    ("reservation_by_book_id", "select_locked_books", BOOK_PARTITION_DELETES),
+]
+# Execution profile of each statement, other statements and batches are
+# writes and use the default profile, other scans the scan profile
+STATEMENT_PROFILES = {
+    "lock_book": LOCK_PROFILE,
+    "renew_lock": LOCK_PROFILE,
+    "select_book": CATALOG_PROFILE,
+    "select_books": CATALOG_PROFILE,
+    "select_catalog_version": CATALOG_PROFILE,
+    "select_reservation": READ_PROFILE,
+    "select_book_reservation": READ_PROFILE,
+}
+
+RESERVATION_TABLES = ["reservations", "user_reservations", "book_reservations", "reservation_by_book_id"]
+
+
+class CassandraBackend(StorageBackend):
+    """
+    Storage on a Cassandra cluster. `cluster_factory` builds a Cluster with
+    the execution profiles of cassandra_config, e.g. `cluster_from_env`.
+    Nothing is connected until `start`.
+    """
+    def __init__(self, cluster_factory, keyspace="library", max_in_flight=128, batch_mode="logged", trace_sample_rate=0.0, lease_ttl=0):
+        if batch_mode not in BATCH_TYPES:
+            raise ValueError(f"Unknown batch mode: {batch_mode}")
+        self.batch_mode = batch_mode
+        # Seconds the reservation rows live (the lock a bit longer), 0 keeps them until deleted
+        self.lease_ttl = lease_ttl
+        self.trace_sample_rate = trace_sample_rate
+        self.cluster_factory = cluster_factory
+        self.cluster = None
+        self.keyspace = keyspace
+        self.session = None
+        self.statements = None
+        # Bounds the number of concurrent Cassandra round-trips
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def start(self):
+        """
+        Connect (fetching the schema metadata), prepare every statement on
+        all nodes and send a request to every node that is up, so the
+        connections exist before the first request.
+        """
+        loop = asyncio.get_event_loop()
+        # connect and prepare block, keep the loop serving /health meanwhile
+        if self.session is None:
+            if self.cluster is None:
+                self.cluster = self.cluster_factory()
+            try:
+                self.session = await loop.run_in_executor(None, self.cluster.connect, self.keyspace)
+            except Exception:
+                # A Cluster that failed to connect is shut down for good,
+                # the next attempt builds a new one
+                cluster, self.cluster = self.cluster, None
+                await loop.run_in_executor(None, cluster.shutdown)
+                raise
+        if self.statements is None:
+            self.statements = await loop.run_in_executor(None, StatementRegistry, self.session)
+
+        hosts = [host for host in self.cluster.metadata.all_hosts() if host.is_up]
+        await asyncio.gather(*(
+            self._timed("warm_host", execute_async(self.session, "SELECT release_version FROM system.local", host=host))
+            for host in hosts
+        ))
+        log.info("Connected to %d Cassandra nodes", len(hosts))
+
+    def _tracer(self, label):
+        if not self.trace_sample_rate or random.random() >= self.trace_sample_rate:
+            return None
+        return lambda response_future: self._log_trace(label, response_future)
+
+    def _log_trace(self, label, response_future):
+        # Runs in an executor thread, fetching the trace blocks
+        try:
+            trace = response_future.get_query_trace()
+        except Exception:
+            log.exception("Failed to fetch the trace of %s", label)
+            return
+        events = "; ".join(f"{event.source_elapsed} {event.source} {event.description}" for event in trace.events)
+        log.info("Trace %s of %s: %s on %s: %s", trace.trace_id, label, trace.duration, trace.coordinator, events)
+
+    async def _timed(self, label, request):
+        started = time.perf_counter()
+        try:
+            result = await request
+        except Exception as e:
+            QUERY_DURATION.observe(time.perf_counter() - started, label, "error")
+            QUERY_ERRORS.inc(label, type(e).__name__)
+            raise
+        QUERY_DURATION.observe(time.perf_counter() - started, label, "ok")
+        return result
+
+    async def _execute(self, statement, parameters=None, timeout=None, label=None):
+        profile = EXEC_PROFILE_DEFAULT
+        if isinstance(statement, str):
+            label = label or statement
+            profile = STATEMENT_PROFILES.get(statement, EXEC_PROFILE_DEFAULT)
+            statement = self.statements[statement]
+        async with self.in_flight:
+            request = execute_async(self.session, statement, parameters, timeout, self._tracer(label), profile)
+            return await self._timed(label, request)
+
+    async def _write(self, label, *writes):
+        """
+        Apply `(statement name, parameters)` writes in a single round-trip
+        according to `batch_mode`.
+        """
+        batch_type = BATCH_TYPES[self.batch_mode]
+        if batch_type is None:
+            await asyncio.gather(*(self._execute(name, parameters) for name, parameters in writes))
+            return
+
+        batch = BatchStatement(batch_type=batch_type)
+        for name, parameters in writes:
+            batch.add(self.statements[name], parameters)
+        await self._execute(batch, label=f"batch:{label}")
+
+    async def _fetch_page(self, name, parameters=None, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        statement = self.statements[name].bind(parameters or ())
+        statement.fetch_size = page_size
+        async with self.in_flight:
+            request = fetch_page(self.session, statement, paging_state, self._tracer(name), STATEMENT_PROFILES.get(name, SCAN_PROFILE))
+            return await self._timed(name, request)
+
+    async def lock_book(self, book_id, reservation_id):
+        result = await self._execute("lock_book", (book_id, reservation_id, lock_ttl(self.lease_ttl)))
+        return result[0][0]
+
+    async def unlock_book(self, book_id):
+        await self._execute("unlock_book", (book_id,))
+
+    async def get_book(self, book_id):
+        rows = await self._execute("select_book", (book_id,))
+        return rows[0] if rows else None
+
+    async def books_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        return await self._fetch_page("select_books", page_size=page_size, paging_state=paging_state)
+
+    async def catalog_version(self):
+        rows = await self._execute("select_catalog_version", ("books",))
+        return rows[0][0] if rows else None
+
+    async def bump_catalog_version(self):
+        await self._execute("bump_catalog_version", ("books",))
+
+    def _reservation_writes(self, reservation_id, book_id, user_id, reserved_at):
+        ttl = self.lease_ttl
+        return [
+            ("insert_book_reservation", (book_id, reservation_id, user_id, reserved_at, ttl)),
+            ("insert_reservation", (reservation_id, book_id, user_id, reserved_at, ttl)),
+            ("insert_user_reservation", (user_id, reservation_id, book_id, reserved_at, ttl)),
+        ]
+
+    @staticmethod
+    def _reservation_deletes(reservation_id, book_id, user_id):
+        return [
+            ("delete_book_reservation", (book_id, reservation_id)),
+            ("delete_reservation", (book_id, user_id)),
+            ("delete_user_reservation", (user_id, reservation_id)),
+            ("unlock_book", (book_id,)),
+        ]
+
+    async def add_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        await self._write("add_reservation", *self._reservation_writes(reservation_id, book_id, user_id, reserved_at))
+
+    async def add_reservations(self, reservations):
+        writes = [write for reservation in reservations for write in self._reservation_writes(*reservation)]
+        await self._write("add_reservations", *writes)
+
+    def write_may_have_applied(self, error):
+        # A timed out write may have reached some replicas, a logged batch
+        # is then replayed from the batchlog
+        return isinstance(error, (WriteTimeout, OperationTimedOut))
+
+    async def get_reservation(self, user_id, book_id):
+        rows = await self._execute("select_reservation", (user_id, book_id))
+        return rows[0] if rows else None
+
+    async def get_book_reservation(self, book_id):
+        rows = await self._execute("select_book_reservation", (book_id,))
+        return rows[0] if rows else None
+
+    async def touch_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        if self.lease_ttl:
+            # Renew the lock only if it is still ours: once the lease expired
+            # another reservation may hold it
+            result = await self._execute("renew_lock", (lock_ttl(self.lease_ttl), reservation_id, book_id, reservation_id))
+            if not result[0][0]:
+                return False
+            # An UPDATE would only renew reserved_at, the whole rows are
+            # written again with a fresh TTL
+            await self._write("renew_reservation", *self._reservation_writes(reservation_id, book_id, user_id, reserved_at))
+            return True
+        await self._write(
+            "touch_reservation",
+            ("update_reservation", (reserved_at, user_id, book_id)),
+            ("update_user_reservation", (reserved_at, reservation_id, user_id)),
+            ("update_book_reservation", (reserved_at, reservation_id, book_id)),
+        )
+        return True
+
+    async def delete_reservation(self, reservation_id, book_id, user_id):
+        # Remove the reservation together with the lock
+        await self._write("delete_reservation", *self._reservation_deletes(reservation_id, book_id, user_id))
+
+    async def delete_reservations(self, reservations):
+        deletes = [delete for reservation in reservations for delete in self._reservation_deletes(*reservation)]
+        await self._write("delete_reservations", *deletes)
+
+    async def reservations_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        return await self._fetch_page("select_reservations", page_size=page_size, paging_state=paging_state)
+
+    async def user_reservations_page(self, user_id, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        return await self._fetch_page("select_user_reservations", (user_id,), page_size, paging_state)
+
+    async def clear_reservations(self, truncate=False, concurrency=64):
+        """
+        Partitions are deleted in parallel, or the tables are truncated when
+        `truncate` is set.
+        """
+        if truncate:
+            for table in RESERVATION_TABLES:
+                await self._execute(SimpleStatement(f"TRUNCATE {table}"), timeout=120, label=f"truncate:{table}")
+                yield {"table": table, "truncated": True, "done": True}
+            return
+
+        limit = asyncio.Semaphore(concurrency)
+
+        async def delete_partition(key, deletes):
+            # Every delete targets the same partition key, so one unlogged
+            # batch is handled by a single replica set
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for name in deletes:
+                batch.add(self.statements[name], (key,))
+            async with limit:
+                await self._execute(batch, label="batch:clear_partition")
+
+        for table, query, deletes in RESERVATION_PARTITIONS:
+            deleted = 0
+            paging_state = None
+            while True:
+                rows, paging_state = await self._fetch_page(query, page_size=MAX_PAGE_SIZE, paging_state=paging_state)
+                await asyncio.gather(*(delete_partition(row[0], deletes) for row in rows))
+                deleted += len(rows)
+                yield {"table": table, "partitions_deleted": deleted, "done": paging_state is None}
+                if paging_state is None:
+                    break
+
+    def close(self):
+        if self.cluster is not None:
+            self.cluster.shutdown()
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import logging
+from storage import Book
+
+log = logging.getLogger(__name__)
+
+# Position of the indexed fields in a book row
+INDEXED_FIELDS = {name: Book._fields.index(name) for name in ("genre", "author", "published_year")}
+
+
+class BookCatalog:
+    """
+    In-process copy of the books table, indexed by genre, author and
+    published_year.
+
+    The catalog is reloaded after `ttl` seconds (stale data is served while the
+    reload runs), after `invalidate`, or when the version written by
+    populate_database.py changes. The version is checked at most every
+    `check_interval` seconds.
+
+    Books are rows in the field order of `Book`. Query results are returned
+    already encoded by `encode` and the encoded pages are kept until the next
+    reload, up to `max_cached_bytes` of them (0 disables the cache).
+    """
+    def __init__(self, load_books, load_version, encode, ttl=300, check_interval=5, max_cached_bytes=16 * 2 ** 20):
+        self.load_books = load_books
+        self.load_version = load_version
+        self.encode = encode
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.max_cached_bytes = max_cached_bytes
+        self.books = []
+        self.indexes = {name: {} for name in INDEXED_FIELDS}
+        self.pages = {}
+        self.cached_bytes = 0
+        self.version = None
+        self.loaded_at = None
+        self.checked_at = None
+        self._reloading = None
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    async def load(self):
+        """Load the books now, e.g. before serving the first request."""
+        await self._reload()
+
+    async def query(self, page=1, limit=100, genre=None, author=None, published_year=None):
+        """
+        Return one encoded page of books matching all given filters and the
+        total number of matches.
+        """
+        await self._refresh_if_needed()
+
+        filters = {"genre": genre, "author": author, "published_year": published_year}
+        filters = {name: _index_key(value) for name, value in filters.items() if value is not None}
+        key = (page, limit, tuple(sorted(filters.items())))
+        cached = self.pages.get(key)
+        if cached is not None:
+            return cached
+
+        if filters:
+            # Start from the most selective index and check the rest per book
+            candidates = min((self.indexes[name].get(value, []) for name, value in filters.items()), key=len)
+            matches = [
+                self.books[i] for i in candidates
+                if all(_index_key(self.books[i][INDEXED_FIELDS[name]]) == value for name, value in filters.items())
+            ]
+        else:
+            matches = self.books
+
+        start = (page - 1) * limit
+        result = self.encode(matches[start:start + limit]), len(matches)
+        self._cache(key, result)
+        return result
+
+    def _cache(self, key, result):
+        size = len(result[0])
+        if size > self.max_cached_bytes:
+            return
+        # Start over once the pages would take more than the budget
+        if self.cached_bytes + size > self.max_cached_bytes:
+            self.pages.clear()
+            self.cached_bytes = 0
+        self.pages[key] = result
+        self.cached_bytes += size
+
+    async def _refresh_if_needed(self):
+        now = time.monotonic()
+        if self.loaded_at is None:
+            await self._reload()
+        elif now - self.loaded_at >= self.ttl:
+            self._in_background(self._reload())
+        elif now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            self._in_background(self._reload_if_changed())
+
+    async def _reload_if_changed(self):
+        if await self.load_version() != self.version:
+            await self._reload()
+
+    def _reload(self):
+        # Concurrent callers share a single reload
+        if self._reloading is None:
+            self._reloading = asyncio.ensure_future(self._load())
+            self._reloading.add_done_callback(self._reloaded)
+        return asyncio.shield(self._reloading)
+
+    def _reloaded(self, future):
+        self._reloading = None
+
+    async def _load(self):
+        version = await self.load_version()
+        books = await self.load_books()
+
+        indexes = {name: {} for name in self.indexes}
+        for i, book in enumerate(books):
+            for name, index in indexes.items():
+                index.setdefault(_index_key(book[INDEXED_FIELDS[name]]), []).append(i)
+
+        self.books, self.indexes, self.version = books, indexes, version
+        self.pages = {}
+        self.cached_bytes = 0
+        self.loaded_at = self.checked_at = time.monotonic()
+        log.info("Loaded %d books into the catalog", len(books))
+
+    def _in_background(self, awaitable):
+        future = asyncio.ensure_future(awaitable)
+        future.add_done_callback(_log_failure)
+
+
+def _index_key(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("Failed to refresh the book catalog", exc_info=future.exception())
@@ -0,0 +1,71 @@
+import time
+import asyncio
+from metrics import LOCK_ATTEMPTS
+
+
+class BookLocks:
+    """
+    Per-process front of `backend.lock_book`, so a contended book costs one
+    lightweight transaction instead of one per request.
+
+    Concurrent attempts on the same book share the outcome of a single
+    `lock_book` call: only the first caller can acquire the lock, the others
+    see the book as reserved. Books seen locked are remembered for `ttl`
+    seconds (0 disables the cache). The cache only knows about this process,
+    a reservation removed through another worker can be reported as reserved
+    for up to `ttl` seconds.
+    """
+    # Expired entries are dropped once the cache grows past this size
+    PRUNE_SIZE = 10000
+
+    def __init__(self, backend, ttl=1.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.locked = {}  # book_id -> expiry
+        self.in_flight = {}  # book_id -> future of lock_book
+
+    def _cached(self, book_id):
+        expiry = self.locked.get(book_id)
+        if expiry is None:
+            return False
+        if expiry <= time.monotonic():
+            del self.locked[book_id]
+            return False
+        return True
+
+    def _remember(self, book_id):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        if len(self.locked) >= self.PRUNE_SIZE:
+            self.locked = {key: expiry for key, expiry in self.locked.items() if expiry > now}
+        self.locked[book_id] = now + self.ttl
+
+    def invalidate(self, book_id=None):
+        """Forget that `book_id` (every book when None) is locked."""
+        if book_id is None:
+            self.locked.clear()
+        else:
+            self.locked.pop(book_id, None)
+
+    async def acquire(self, book_id, reservation_id):
+        """Take the lock of a book for a reservation, return whether this caller got it."""
+        if self._cached(book_id):
+            LOCK_ATTEMPTS.inc("cached")
+            return False
+
+        future = self.in_flight.get(book_id)
+        if future is not None:
+            LOCK_ATTEMPTS.inc("coalesced")
+            # The leader's lock is not ours, but its errors are
+            await asyncio.shield(future)
+            return False
+
+        future = self.in_flight[book_id] = asyncio.ensure_future(self.backend.lock_book(book_id, reservation_id))
+        try:
+            acquired = await asyncio.shield(future)
+        finally:
+            del self.in_flight[book_id]
+        LOCK_ATTEMPTS.inc("acquired" if acquired else "already_reserved")
+        self._remember(book_id)
+        return acquired
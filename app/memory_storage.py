@@ -0,0 +1,193 @@
+import csv
+import time
+import uuid
+import heapq
+import asyncio
+from storage import StorageBackend, Book, Reservation, DEFAULT_PAGE_SIZE
+
+# A lightweight transaction is a four round-trip Paxos exchange
+LWT_ROUND_TRIPS = 4
+
+
+def read_books_csv(file_path):
+    with open(file_path, mode='r') as file:
+        for row in csv.DictReader(file):
+            yield Book(uuid.UUID(row['book_id']), row['title'], row['author'], row['genre'], int(row['published_year']))
+
+
+class MemoryBackend(StorageBackend):
+    """
+    In-process stand-in for the Cassandra tables, for benchmarking the app
+    without a cluster. Writes are upserts and deletes of missing rows are
+    no-ops, like in CQL. `lock_book` behaves like INSERT ... IF NOT EXISTS.
+    Every simulated round-trip waits `latency` seconds. With a `lease_ttl`
+    the lock and the reservations of a book expire together, and only the
+    reservation holding the lock can renew its lease.
+    """
+    def __init__(self, books=(), latency=0.0, lease_ttl=0):
+        self.latency = latency
+        self.lease_ttl = lease_ttl
+        self.books = {book.book_id: book for book in books}
+        self.version = uuid.uuid1()
+        # Tables keyed by their primary key
+        self.reservations = {}  # (user_id, book_id)
+        self.user_reservations = {}  # user_id -> {reservation_id}
+        self.book_reservations = {}  # book_id -> {reservation_id}
+        self.locks = {}  # book_id -> reservation_id
+        self.leases = {}  # book_id -> expiry
+        self.expiries = []  # heap of (expiry, book_id), stale when renewed
+
+    @classmethod
+    def from_csv(cls, file_path, latency=0.0, lease_ttl=0):
+        return cls(read_books_csv(file_path), latency, lease_ttl)
+
+    async def _round_trip(self, count=1):
+        # Always yield to the loop so concurrent requests interleave
+        await asyncio.sleep(self.latency * count)
+        self._expire()
+
+    def _lease(self, book_id):
+        if not self.lease_ttl:
+            return
+        expiry = self.leases[book_id] = time.monotonic() + self.lease_ttl
+        heapq.heappush(self.expiries, (expiry, book_id))
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, book_id = heapq.heappop(self.expiries)
+            if self.leases.get(book_id) != expiry:
+                continue
+            del self.leases[book_id]
+            for reservation in list(self.book_reservations.get(book_id, {}).values()):
+                self._remove(reservation.reservation_id, book_id, reservation.user_id)
+            self.locks.pop(book_id, None)
+
+    def _remove(self, reservation_id, book_id, user_id):
+        self._delete(self.book_reservations, book_id, reservation_id)
+        self.reservations.pop((user_id, book_id), None)
+        self._delete(self.user_reservations, user_id, reservation_id)
+
+    @staticmethod
+    def _upsert(partition, key, row):
+        existing = partition.get(key)
+        if existing is not None:
+            row = existing._replace(**{field: value for field, value in row._asdict().items() if value is not None})
+        partition[key] = row
+
+    @staticmethod
+    def _delete(partitions, partition_key, key):
+        partition = partitions.get(partition_key, {})
+        partition.pop(key, None)
+        if not partition:
+            partitions.pop(partition_key, None)
+
+    @staticmethod
+    def _page(rows, page_size, paging_state):
+        start = int(paging_state) if paging_state else 0
+        end = start + page_size
+        return rows[start:end], (str(end).encode() if end < len(rows) else None)
+
+    async def lock_book(self, book_id, reservation_id):
+        await self._round_trip(LWT_ROUND_TRIPS)
+        # No await between the check and the insert, so this is atomic
+        if book_id in self.locks:
+            return False
+        self.locks[book_id] = reservation_id
+        self._lease(book_id)
+        return True
+
+    async def unlock_book(self, book_id):
+        await self._round_trip()
+        self.locks.pop(book_id, None)
+        self.leases.pop(book_id, None)
+
+    async def get_book(self, book_id):
+        await self._round_trip()
+        return self.books.get(book_id)
+
+    async def books_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        await self._round_trip()
+        return self._page(list(self.books.values()), page_size, paging_state)
+
+    async def catalog_version(self):
+        await self._round_trip()
+        return self.version
+
+    async def bump_catalog_version(self):
+        await self._round_trip()
+        self.version = uuid.uuid1()
+
+    async def add_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        await self.add_reservations([(reservation_id, book_id, user_id, reserved_at)])
+
+    async def add_reservations(self, reservations):
+        await self._round_trip()
+        for reservation_id, book_id, user_id, reserved_at in reservations:
+            reservation = Reservation(reservation_id, book_id, user_id, reserved_at)
+            self._upsert(self.book_reservations.setdefault(book_id, {}), reservation_id, reservation)
+            self._upsert(self.reservations, (user_id, book_id), reservation)
+            self._upsert(self.user_reservations.setdefault(user_id, {}), reservation_id, reservation)
+            self._lease(book_id)
+
+    async def get_reservation(self, user_id, book_id):
+        await self._round_trip()
+        return self.reservations.get((user_id, book_id))
+
+    async def get_book_reservation(self, book_id):
+        await self._round_trip()
+        # Clustered by reservation_id, the first row in clustering order
+        partition = self.book_reservations.get(book_id)
+        return partition[min(partition)] if partition else None
+
+    async def touch_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        if self.lease_ttl:
+            # Renewing the lock is a lightweight transaction
+            await self._round_trip(LWT_ROUND_TRIPS)
+            if self.locks.get(book_id) != reservation_id:
+                return False
+            self._lease(book_id)
+        await self._round_trip()
+        self._upsert(self.reservations, (user_id, book_id), Reservation(None, book_id, user_id, reserved_at))
+        self._upsert(self.user_reservations.setdefault(user_id, {}), reservation_id, Reservation(reservation_id, None, user_id, reserved_at))
+        self._upsert(self.book_reservations.setdefault(book_id, {}), reservation_id, Reservation(reservation_id, book_id, None, reserved_at))
+        return True
+
+    async def delete_reservation(self, reservation_id, book_id, user_id):
+        await self.delete_reservations([(reservation_id, book_id, user_id)])
+
+    async def delete_reservations(self, reservations):
+        await self._round_trip()
+        for reservation_id, book_id, user_id in reservations:
+            self._remove(reservation_id, book_id, user_id)
+            self.locks.pop(book_id, None)
+            self.leases.pop(book_id, None)
+
+    async def reservations_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        await self._round_trip()
+        return self._page(list(self.reservations.values()), page_size, paging_state)
+
+    async def user_reservations_page(self, user_id, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        await self._round_trip()
+        # Clustered by reservation_id
+        partition = self.user_reservations.get(user_id, {})
+        return self._page([partition[key] for key in sorted(partition)], page_size, paging_state)
+
+    async def clear_reservations(self, truncate=False, concurrency=64):
+        tables = [
+            ("reservations", self.reservations, {user_id for user_id, _ in self.reservations}),
+            ("user_reservations", self.user_reservations, self.user_reservations),
+            ("book_reservations", self.book_reservations, self.book_reservations),
+            ("reservation_by_book_id", self.locks, self.locks),
+        ]
+        for table, rows, partitions in tables:
+            await self._round_trip()
+            report = {"table": table, "done": True}
+            if truncate:
+                report["truncated"] = True
+            else:
+                report["partitions_deleted"] = len(partitions)
+            rows.clear()
+            yield report
+        self.leases.clear()
+        self.expiries.clear()
@@ -0,0 +1,134 @@
+import time
+import bisect
+import functools
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Observations only increment a bucket counter,
+    buckets are made cumulative when rendered.
+    """
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket (last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "library_http_request_duration_seconds", "Time spent handling HTTP requests.", ["handler", "method", "status"])
+OPERATION_DURATION = REGISTRY.histogram(
+    "library_operation_duration_seconds", "Time spent in LibrarySystem operations.", ["operation", "outcome"])
+QUERY_DURATION = REGISTRY.histogram(
+    "library_query_duration_seconds", "Time spent executing Cassandra statements.", ["statement", "outcome"])
+QUERY_ERRORS = REGISTRY.counter(
+    "library_query_errors_total", "Cassandra statements that failed, by exception type.", ["statement", "error"])
+LOCK_ATTEMPTS = REGISTRY.counter(
+    "library_lock_attempts_total", "Book lock attempts by outcome.", ["outcome"])
+OPERATION_ERRORS = REGISTRY.counter(
+    "library_operation_errors_total", "Unexpected exceptions in LibrarySystem operations.", ["operation", "error"])
+LOCKS_KEPT = REGISTRY.counter(
+    "library_locks_kept_total", "Book locks kept after a failed reservation write that may have been applied.", ["operation"])
+
+ADMISSION_QUEUE_WAIT = REGISTRY.histogram(
+    "library_admission_queue_wait_seconds", "Time admitted requests waited for a slot.", ["class"])
+ADMISSION_REJECTED = REGISTRY.counter(
+    "library_admission_rejected_total", "Requests shed by admission control.", ["class", "reason"])
+
+
+def timed(operation):
+    """
+    Record the duration of an async LibrarySystem operation. Results with an
+    "error" key count as rejected.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "exception"
+            try:
+                result = await method(*args, **kwargs)
+                outcome = "rejected" if isinstance(result, dict) and "error" in result else "ok"
+                return result
+            finally:
+                OPERATION_DURATION.observe(time.perf_counter() - started, operation, outcome)
+        return wrapper
+    return decorator
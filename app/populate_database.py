@@ -1,5 +1,11 @@
 import csv
-from cassandra.cluster import Cluster
+import time
+import os
+from cassandra import InvalidRequest
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import BatchStatement, BatchType
+from cassandra_config import cluster_from_env, keyspace_from_env
+from statements import StatementRegistry
 from faker import Faker
 import uuid
 import argparse
@@ -7,18 +13,15 @@ import argparse
 # Initialize Faker
 fake = Faker()
 
-# Function to read books from CSV and insert into the database
-def insert_books_from_csv(session, file_path):
+# Function to stream book records from a CSV file
+def read_books_csv(file_path):
     with open(file_path, mode='r') as file:
         reader = csv.DictReader(file)
         for row in reader:
-            session.execute("""
-                INSERT INTO books (book_id, title, author, genre, published_year) 
-                VALUES (%s, %s, %s, %s, %s)
-            """, (uuid.UUID(row['book_id']), row['title'], row['author'], row['genre'], int(row['published_year'])))
+            yield (uuid.UUID(row['book_id']), row['title'], row['author'], row['genre'], int(row['published_year']))
 
-# Function to insert randomly generated books into the database
-def insert_random_books(session, num_records=200):
+# Function to generate random book records
+def generate_random_books(num_records=200):
     genres = ['Mystery', 'Thriller', 'Romance', 'Science Fiction', 'Fantasy', 'Horror', 'Historical Fiction', 'Non-Fiction']
     for _ in range(num_records):
         book_id = uuid.uuid4()
@@ -26,23 +29,91 @@ def insert_random_books(session, num_records=200):
         author = fake.name()
         genre = fake.random_element(elements=genres)
         published_year = int(fake.year())
-        session.execute("""
-            INSERT INTO books (book_id, title, author, genre, published_year) 
-            VALUES (%s, %s, %s, %s, %s)
-        """, (book_id, title, author, genre, published_year))
-
-def main(csv_file=None, num_records=200):
-    contact_points = ['cas1', 'cas2', 'cas3']
-    cluster = Cluster(contact_points=contact_points)
+        yield (book_id, title, author, genre, published_year)
+
+# Function to insert books one at a time
+def insert_books(session, statement, books):
+    for book in books:
+        session.execute(statement, book)
+
+def group_batches(session, statement, books, batch_size):
+    """
+    Group books into lists of up to `batch_size` rows owned by the same
+    primary replica, so each unlogged batch is handled by a single node.
+    """
+    metadata = session.cluster.metadata
+    groups = {}
+    for book in books:
+        bound = statement.bind(book)
+        replicas = metadata.get_replicas(bound.keyspace, bound.routing_key)
+        key = replicas[0] if replicas else None
+        group = groups.setdefault(key, [])
+        group.append(book)
+        if len(group) == batch_size:
+            yield groups.pop(key)
+    yield from groups.values()
+
+def execute_batches(session, statement, batches, concurrency, retries):
+    """
+    Insert `batches` concurrently, retrying the failed ones with a backoff.
+    Returns the batches that still failed after `retries` retries.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+        statements = []
+        for batch in batches:
+            batch_statement = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for book in batch:
+                batch_statement.add(statement, book)
+            statements.append((batch_statement, ()))
+        results = execute_concurrent(session, statements, concurrency=concurrency, raise_on_first_error=False)
+        failed = [(batch, result) for batch, (success, result) in zip(batches, results) if not success]
+        if not failed:
+            return []
+        batches = [batch for batch, _ in failed]
+    print(f"Giving up on {len(batches)} batches, last error: {failed[-1][1]}")
+    return batches
+
+# Function to insert books concurrently in unlogged batches
+def bulk_insert_books(session, statement, books, concurrency=64, batch_size=10, retries=3):
+    inserted = failed = 0
+    started = time.monotonic()
+    chunk = []
+
+    def flush(chunk):
+        nonlocal inserted, failed
+        failed_batches = execute_batches(session, statement, chunk, concurrency, retries)
+        failed_rows = sum(len(batch) for batch in failed_batches)
+        inserted += sum(len(batch) for batch in chunk) - failed_rows
+        failed += failed_rows
+        print(f"{inserted} books inserted, {failed} failed ({inserted / (time.monotonic() - started):.0f} rows/s)")
+
+    # Work through the stream in chunks so memory stays bounded
+    for batch in group_batches(session, statement, books, batch_size):
+        chunk.append(batch)
+        if len(chunk) == concurrency * 16:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    elapsed = time.monotonic() - started
+    print(f"Bulk load finished: {inserted} books in {elapsed:.1f}s ({inserted / max(elapsed, 1e-9):.0f} rows/s), {failed} failed")
+
+def main(csv_file=None, num_records=200, bulk=False, concurrency=64, batch_size=10, retries=3):
+    cluster = cluster_from_env()
     session = cluster.connect()
+    keyspace = keyspace_from_env()
+    datacenter = os.environ.get("CASSANDRA_LOCAL_DC") or "datacenter1"
 
     # Create keyspace
-    session.execute("""
-        CREATE KEYSPACE IF NOT EXISTS library 
-        WITH replication = {'class': 'NetworkTopologyStrategy', 'datacenter1': 3}
+    session.execute(f"""
+        CREATE KEYSPACE IF NOT EXISTS {keyspace}
+        WITH replication = {{'class': 'NetworkTopologyStrategy', '{datacenter}': 3}}
     """)
 
-    session.execute("USE library")
+    session.execute(f"USE {keyspace}")
 
     # Create books table
     session.execute("""
@@ -88,22 +159,47 @@ def main(csv_file=None, num_records=200):
         )
     """)
 
-    # Create reservation_by_book_id table
+    # Create reservation_by_book_id table, the lock of a book holds the
+    # reservation it was taken for
     session.execute("""
         CREATE TABLE IF NOT EXISTS reservation_by_book_id (
-            book_id UUID PRIMARY KEY
+            book_id UUID PRIMARY KEY,
+            reservation_id UUID
+        )
+    """)
+    try:
+        session.execute("ALTER TABLE reservation_by_book_id ADD reservation_id UUID")
+    except InvalidRequest:
+        pass  # Already there
+
+    # Create catalog_version table, bumped after every load so running
+    # servers reload their book catalog
+    session.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            name TEXT PRIMARY KEY,
+            version TIMEUUID
         )
     """)
 
     print("Tables created successfully.")
+
+    statements = StatementRegistry(session)
+    insert_book = statements["insert_book"]
     print("Populating books...")
 
     if csv_file is not None:
         print(f"Inserting book records from {csv_file}...")
-        insert_books_from_csv(session, csv_file)
+        books = read_books_csv(csv_file)
     else:
         print(f"Generating {num_records} random book records...")
-        insert_random_books(session, num_records)
+        books = generate_random_books(num_records)
+
+    if bulk:
+        bulk_insert_books(session, insert_book, books, concurrency, batch_size, retries)
+    else:
+        insert_books(session, insert_book, books)
+
+    session.execute(statements["bump_catalog_version"], ("books",))
 
     print("Books populated successfully.")
 
@@ -111,7 +207,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Populate Cassandra database with book records.')
     parser.add_argument('--csv_file', type=str, help='Path to the CSV file containing book records.')
     parser.add_argument('--num_records', type=int, default=200, help='Number of random book records to generate if not using a CSV file.')
+    parser.add_argument('--bulk', action='store_true', help='Insert books concurrently in unlogged batches.')
+    parser.add_argument('--concurrency', type=int, default=64, help='Number of concurrent requests in bulk mode.')
+    parser.add_argument('--batch_size', type=int, default=10, help='Number of books per batch in bulk mode.')
+    parser.add_argument('--retries', type=int, default=3, help='Number of retries for failed batches in bulk mode.')
     
     args = parser.parse_args()
 
-    main(args.csv_file, args.num_records)
\ No newline at end of file
+    main(args.csv_file, args.num_records, args.bulk, args.concurrency, args.batch_size, args.retries)
\ No newline at end of file
@@ -0,0 +1,72 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoders of the JSON scalars, anything else (UUID, datetime) is written as
+# its str(), like json.dumps(default=str) would
+_SCALARS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: json.dumps,
+    bool: lambda value: "true" if value else "false",
+    type(None): lambda value: "null",
+}
+
+
+def _scalar(value):
+    encode = _SCALARS.get(type(value))
+    return encode(value) if encode is not None else encode_basestring_ascii(str(value))
+
+
+def dumps(obj):
+    """
+    Encode `obj` to JSON bytes, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=str).encode()
+
+
+class ObjectEncoder:
+    """
+    Encodes sequences of JSON objects as the body of an array, a whole
+    array, or one object per line (NDJSON), as bytes ready to be written.
+    """
+    def encode(self, item):
+        return dumps(item)
+
+    def items(self, items):
+        return b",".join(self.encode(item) for item in items)
+
+    def array(self, items):
+        return b"[" + self.items(items) + b"]"
+
+    def lines(self, items):
+        return b"".join(self.encode(item) + b"\n" for item in items)
+
+
+class RowEncoder(ObjectEncoder):
+    """
+    Encodes tuple rows as JSON objects keyed by `fields`. Without orjson the
+    object is formatted from a template in one pass instead of building a
+    dict for json.dumps.
+    """
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.template = "{" + ", ".join(f"{encode_basestring_ascii(field)}: %s" for field in self.fields) + "}"
+
+    def encode(self, row):
+        if orjson is not None:
+            return dumps(dict(zip(self.fields, row)))
+        return (self.template % tuple(map(_scalar, row))).encode()
+
+    def items(self, rows):
+        if orjson is not None:
+            # A single call for the whole page, minus the brackets
+            return dumps([dict(zip(self.fields, row)) for row in rows])[1:-1]
+        template = self.template
+        return ",".join(template % tuple(map(_scalar, row)) for row in rows).encode()
@@ -0,0 +1,72 @@
+# Every query sent by the library, prepared once per session. The lock and
+# reservation inserts take a TTL in seconds as their last parameter, 0 for none
+QUERIES = {
+    "lock_book": "INSERT INTO reservation_by_book_id (book_id, reservation_id) VALUES (?, ?) IF NOT EXISTS USING TTL ?",
+    "renew_lock": """
+        UPDATE reservation_by_book_id USING TTL ? SET reservation_id = ?
+        WHERE book_id = ? IF reservation_id = ?
+    """,
+    "unlock_book": "DELETE FROM reservation_by_book_id WHERE book_id = ?",
+    "select_book": "SELECT book_id, title, author, genre, published_year FROM books WHERE book_id = ?",
+    "select_books": "SELECT book_id, title, author, genre, published_year FROM books",
+    "select_catalog_version": "SELECT version FROM catalog_version WHERE name = ?",
+    "bump_catalog_version": "INSERT INTO catalog_version (name, version) VALUES (?, now())",
+    "insert_book": """
+        INSERT INTO books (book_id, title, author, genre, published_year)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "insert_book_reservation": """
+        INSERT INTO book_reservations (book_id, reservation_id, user_id, reserved_at)
+        VALUES (?, ?, ?, ?) USING TTL ?
+    """,
+    "insert_reservation": """
+        INSERT INTO reservations (reservation_id, book_id, user_id, reserved_at)
+        VALUES (?, ?, ?, ?) USING TTL ?
+    """,
+    "insert_user_reservation": """
+        INSERT INTO user_reservations (user_id, reservation_id, book_id, reserved_at)
+        VALUES (?, ?, ?, ?) USING TTL ?
+    """,
+    "select_reservation": "SELECT reservation_id, book_id, user_id, reserved_at FROM reservations WHERE user_id = ? AND book_id = ?",
+    "select_reservations": "SELECT reservation_id, book_id, user_id, reserved_at FROM reservations",
+    "select_book_reservation": "SELECT book_id, reservation_id, user_id, reserved_at FROM book_reservations WHERE book_id = ?",
+    "update_reservation": "UPDATE reservations SET reserved_at = ? WHERE user_id = ? AND book_id = ?",
+    "select_user_reservations": "SELECT reservation_id, book_id, user_id, reserved_at FROM user_reservations WHERE user_id = ?",
+    "update_user_reservation": "UPDATE user_reservations SET reserved_at = ? WHERE reservation_id = ? AND user_id = ?",
+    "update_book_reservation": "UPDATE book_reservations SET reserved_at = ? WHERE reservation_id = ? AND book_id = ?",
+    "delete_book_reservation": "DELETE FROM book_reservations WHERE book_id = ? AND reservation_id = ?",
+    "delete_reservation": "DELETE FROM reservations WHERE book_id = ? AND user_id = ?",
+    "delete_user_reservation": "DELETE FROM user_reservations WHERE user_id = ? AND reservation_id = ?",
+    "select_reservation_users": "SELECT DISTINCT user_id FROM reservations",
+    "select_user_reservation_users": "SELECT DISTINCT user_id FROM user_reservations",
+    "select_book_reservation_books": "SELECT DISTINCT book_id FROM book_reservations",
+    "select_locked_books": "SELECT book_id FROM reservation_by_book_id",
+    "delete_user_reservations_partition": "DELETE FROM reservations WHERE user_id = ?",
+    "delete_user_user_reservations_partition": "DELETE FROM user_reservations WHERE user_id = ?",
+    "delete_book_reservations_partition": "DELETE FROM book_reservations WHERE book_id = ?",
+}
+
+
+class StatementRegistry:
+    """
+    Prepares a set of named queries on a session and hands out the prepared
+    statements. The driver keeps them usable: it prepares them on nodes that
+    come back up, and prepares a statement again when a node answers that it
+    does not know it (e.g. after a restart).
+    """
+    def __init__(self, session, queries=QUERIES):
+        self.session = session
+        self.queries = dict(queries)
+        self.prepared = {}
+        self.prepare_all()
+
+    def prepare_all(self):
+        for name, query in self.queries.items():
+            statement = self.session.prepare(query)
+            # Reads can be sent to another replica by speculative execution
+            statement.is_idempotent = query.lstrip().upper().startswith("SELECT")
+            self.prepared[name] = statement
+
+    def __getitem__(self, name):
+        return self.prepared[name]
+
@@ -5,10 +5,24 @@ document.addEventListener("DOMContentLoaded", () => {
     const makeReservationForm = document.getElementById("make-reservation-form");
     const updateReservationForm = document.getElementById("update-reservation-form");
     const removeReservationForm = document.getElementById("remove-reservation-form");
+    const reservationsUserId = document.getElementById("reservations-user-id");
+
+    const booksPageSize = 100;
+    const previousBooksButton = document.getElementById("books-previous");
+    const nextBooksButton = document.getElementById("books-next");
+    const booksPageLabel = document.getElementById("books-page");
+    let booksPage = 1;
 
     function fetchBooks() {
-        fetch("/api/books")
-            .then(response => response.json())
+        fetch(`/api/books?page=${booksPage}&limit=${booksPageSize}`)
+            .then(response => {
+                const total = parseInt(response.headers.get("X-Total-Count"), 10) || 0;
+                const pages = Math.max(1, Math.ceil(total / booksPageSize));
+                booksPageLabel.textContent = `Page ${booksPage} of ${pages}`;
+                previousBooksButton.disabled = booksPage <= 1;
+                nextBooksButton.disabled = booksPage >= pages;
+                return response.json();
+            })
             .then(data => {
                 booksTable.innerHTML = "";
                 data.forEach(book => {
@@ -23,8 +37,19 @@ document.addEventListener("DOMContentLoaded", () => {
     }
 
     function fetchReservations() {
-        fetch("/api/reservations")
-            .then(response => response.json())
+        // A single user's reservations are read from one partition
+        const userId = reservationsUserId.value.trim();
+        if (userId && !/^\d+$/.test(userId)) {
+            alert("User ID must be a number.");
+            return;
+        }
+        fetch(userId ? `/api/users/${userId}/reservations` : "/api/reservations")
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Failed to load reservations (${response.status})`);
+                }
+                return response.json();
+            })
             .then(data => {
                 reservationsTable.innerHTML = "";
                 data.forEach(reservation => {
@@ -34,7 +59,8 @@ document.addEventListener("DOMContentLoaded", () => {
                     row.insertCell(2).textContent = reservation.user_id;
                     row.insertCell(3).textContent = new Date(reservation.reserved_at).toLocaleString();
                 });
-            });
+            })
+            .catch(error => alert(error.message));
     }
 
     makeReservationForm.addEventListener("submit", event => {
@@ -97,6 +123,18 @@ document.addEventListener("DOMContentLoaded", () => {
             });
     });
 
+    reservationsUserId.addEventListener("change", fetchReservations);
+
+    previousBooksButton.addEventListener("click", () => {
+        booksPage -= 1;
+        fetchBooks();
+    });
+
+    nextBooksButton.addEventListener("click", () => {
+        booksPage += 1;
+        fetchBooks();
+    });
+
     fetchBooks();
     fetchReservations();
 });
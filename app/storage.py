@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+# Row shapes returned by every backend
+Book = namedtuple("Book", ["book_id", "title", "author", "genre", "published_year"])
+Reservation = namedtuple("Reservation", ["reservation_id", "book_id", "user_id", "reserved_at"])
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# Seconds a lease lock outlives the reservation rows, which are written after it
+LOCK_TTL_MARGIN = 30
+
+
+def lock_ttl(lease_ttl):
+    """TTL of the lock of a reservation leased for `lease_ttl` seconds."""
+    return lease_ttl + LOCK_TTL_MARGIN if lease_ttl else 0
+
+
+class StorageBackend:
+    """
+    Data access used by LibrarySystem. Rows have the fields of `Book` and
+    `Reservation`; books and the rows of the `*_page` scans may be plain
+    tuples in the same field order. Paging states are opaque bytes (None once the last page
+    has been returned).
+
+    With a lease TTL the reservation rows expire after that many seconds
+    unless `touch_reservation` renews them, and the lock shortly after.
+    """
+    async def start(self):
+        """Connect and warm up before the first request, may be called again after a failure."""
+        pass
+
+    async def lock_book(self, book_id, reservation_id):
+        """Take the lock of a book for a reservation, return whether it was free."""
+        raise NotImplementedError
+
+    async def unlock_book(self, book_id):
+        raise NotImplementedError
+
+    async def get_book(self, book_id):
+        raise NotImplementedError
+
+    async def books_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        raise NotImplementedError
+
+    async def catalog_version(self):
+        """Return a value that changes whenever the books are reloaded."""
+        raise NotImplementedError
+
+    async def bump_catalog_version(self):
+        """Change the catalog version, making every server reload its books."""
+        raise NotImplementedError
+
+    async def add_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        """Write a reservation to reservations, user_reservations and book_reservations."""
+        raise NotImplementedError
+
+    async def add_reservations(self, reservations):
+        """
+        Write several `(reservation_id, book_id, user_id, reserved_at)`
+        reservations in a single round-trip.
+        """
+        raise NotImplementedError
+
+    def write_may_have_applied(self, error):
+        """
+        Whether a write that failed with `error` may still have been applied,
+        e.g. after a timeout. Otherwise nothing was written.
+        """
+        return False
+
+    async def get_reservation(self, user_id, book_id):
+        raise NotImplementedError
+
+    async def get_book_reservation(self, book_id):
+        raise NotImplementedError
+
+    async def touch_reservation(self, reservation_id, book_id, user_id, reserved_at):
+        """
+        Set reserved_at of a reservation in all three tables and renew its
+        lease. Return False, writing nothing, when the lease has expired and
+        the lock no longer belongs to the reservation.
+        """
+        raise NotImplementedError
+
+    async def delete_reservation(self, reservation_id, book_id, user_id):
+        """Delete a reservation from all three tables and release the book lock."""
+        raise NotImplementedError
+
+    async def delete_reservations(self, reservations):
+        """
+        Delete several `(reservation_id, book_id, user_id)` reservations and
+        their locks in a single round-trip.
+        """
+        raise NotImplementedError
+
+    async def reservations_page(self, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        raise NotImplementedError
+
+    async def user_reservations_page(self, user_id, page_size=DEFAULT_PAGE_SIZE, paging_state=None):
+        """Read the reservations of one user from the user_reservations partition."""
+        raise NotImplementedError
+
+    async def clear_reservations(self, truncate=False, concurrency=64):
+        """Remove every reservation and book lock, yielding progress reports."""
+        raise NotImplementedError
+        yield
+
+    def close(self):
+        pass
@@ -1,163 +1,278 @@
 import csv
-import uuid
 import json
+import math
+import time
+import uuid
 import random
+import asyncio
 import argparse
-import requests
-import concurrent.futures
+from collections import Counter, defaultdict
+
+import aiohttp
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run stress tests on book reservation system.")
     parser.add_argument("test", type=int, choices=range(1, 6), help="Choose a stress test to run (1-5)")
     parser.add_argument("--size", type=int, default=1000, help="Size of the test (default: 1000)")
     parser.add_argument("--workers", type=int, default=4, help="Number of workers to use (default: 4)")
+    parser.add_argument("--url", default="http://localhost:8888", help="Base URL of the server (default: http://localhost:8888)")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+                        help="closed: a fixed number of requests in flight, open: requests sent at a fixed rate "
+                             "(tests 1, 2 and 5; tests 3 and 4 are sequential per client) (default: closed)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight in closed mode (default: 32)")
+    parser.add_argument("--rate", type=float, default=200, help="Requests per second in open mode (default: 200)")
+    parser.add_argument("--connections", type=int, default=100, help="Size of the keep-alive connection pool (default: 100)")
+    parser.add_argument("--output", help="Write the latency report as JSON to this file")
     return parser.parse_args()
 
-def make_reservation(book_id, user_id):
-    url = "http://localhost:8888/make_reservation"
-    payload = {"book_id": str(book_id), "user_id": user_id}
-    response = requests.post(url, json=payload)
-    return response.json()
-
-def update_reservation(book_id, user_id):
-    url = "http://localhost:8888/update_reservation"
-    payload = {"book_id": str(book_id), "user_id": user_id}
-    response = requests.post(url, json=payload)
-    return response.json()
-
-def remove_reservation(book_id, user_id):
-    url = "http://localhost:8888/remove_reservation"
-    payload = {"book_id": str(book_id), "user_id": user_id}
-    response = requests.post(url, json=payload)
-    return response.json()
-
-def make_random_request(user_id, books):
-    request_type = random.choice(["make_reservation", "update_reservation", "remove_reservation"])
-    if request_type == "make_reservation":
-        book_id = random.choice(books)["book_id"]
-        return make_reservation(book_id, user_id)
-    elif request_type == "update_reservation":
-        book_id = random.choice(books)["book_id"]
-        return update_reservation(book_id, user_id)
-    else:
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # nearest-rank percentile
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+class LatencyRecorder:
+    """
+    Collects the latency and the response of every request, per endpoint.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = defaultdict(list)
+        self.results = defaultdict(Counter)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, endpoint, latency, result):
+        self.latencies[endpoint].append(latency)
+        self.results[endpoint][json.dumps(result)] += 1
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def report(self):
+        duration = (self.finished or time.perf_counter()) - self.started
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "throughput_rps": len(latencies) / duration if duration else None,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+                "results": dict(self.results[endpoint]),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "duration_s": duration,
+            "requests": total,
+            "throughput_rps": total / duration if duration else None,
+            "endpoints": endpoints,
+        }
+
+class LoadGenerator:
+    """
+    Sends requests over a shared keep-alive session and records their latency.
+    """
+    def __init__(self, session, base_url, recorder):
+        self.session = session
+        self.base_url = base_url
+        self.recorder = recorder
+
+    async def post(self, endpoint, payload):
+        started = time.perf_counter()
+        try:
+            async with self.session.post(self.base_url + endpoint, json=payload) as response:
+                result = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            result = {"error": type(e).__name__}
+        self.recorder.record(endpoint, time.perf_counter() - started, result)
+        return result
+
+    async def make_reservation(self, book_id, user_id):
+        return await self.post("/make_reservation", {"book_id": str(book_id), "user_id": user_id})
+
+    async def update_reservation(self, book_id, user_id):
+        return await self.post("/update_reservation", {"book_id": str(book_id), "user_id": user_id})
+
+    async def remove_reservation(self, book_id, user_id):
+        return await self.post("/remove_reservation", {"book_id": str(book_id), "user_id": user_id})
+
+    async def make_reservations(self, book_ids, user_id):
+        return await self.post("/make_reservations", {"book_ids": [str(book_id) for book_id in book_ids], "user_id": user_id})
+
+    async def make_random_request(self, user_id, books):
+        request_type = random.choice(["make_reservation", "update_reservation", "remove_reservation"])
         book_id = random.choice(books)["book_id"]
-        return remove_reservation(book_id, user_id)
-    
-def create_initial_reservations(books, user_id):
+        return await getattr(self, request_type)(book_id, user_id)
+
+async def run_closed(requests, concurrency):
+    """
+    Run the `requests` coroutine factories keeping `concurrency` of them in flight.
     """
-    Create initial reservations for a list of books for a given user.
+    requests = iter(requests)
+    results = []
+
+    async def worker():
+        for request in requests:
+            results.append(await request())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+async def run_open(requests, rate):
+    """
+    Start the `requests` coroutine factories at a fixed `rate` per second,
+    regardless of how long the previous ones take.
+    """
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    tasks = []
+    for i, request in enumerate(requests):
+        delay = started + i / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(request()))
+    return await asyncio.gather(*tasks)
+
+def histogram(results):
+    # count number of occurrences of each result
+    return dict(Counter(json.dumps(result) for result in results))
+
+async def create_initial_reservations(generator, books, user_id, batch_size=100, concurrency=8):
+    """
+    Create initial reservations for a list of books for a given user, using
+    the bulk endpoint.
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(make_reservation, book["book_id"], user_id) for book in books]
-        results = [future.result() for future in futures]
-        # Check if all reservations are created successfully
-        success_count = sum(1 for result in results if "message" in result and result["message"] == "Reservation made successfully.")
-        print(f"Created {success_count}/{len(books)} reservations successfully.")
-    
+    book_ids = [book["book_id"] for book in books]
+    requests = [lambda batch=book_ids[i:i + batch_size]: generator.make_reservations(batch, user_id)
+                for i in range(0, len(book_ids), batch_size)]
+    responses = await run_closed(requests, concurrency)
+    # Check if all reservations are created successfully
+    results = [result for response in responses for result in response.get("results", [])]
+    success_count = sum(1 for result in results if result.get("message") == "Reservation made successfully.")
+    print(f"Created {success_count}/{len(books)} reservations successfully.")
 
-def stress_test_1(book_id, user_id, number_of_requests=1000):
+
+async def stress_test_1(generator, run, book_id, user_id, number_of_requests=1000):
     """
     one user makes the same reservation `number_of_requests` times
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(make_reservation, book_id, user_id) for _ in range(number_of_requests)]
-        results = [future.result() for future in futures]
-        # make a histogram of the results
-        # count number of occurrences of each result
-        histogram = {}
-        for result in results:
-            result = json.dumps(result)
-            if result in histogram:
-                histogram[result] += 1
-            else:
-                histogram[result] = 1
-        print(histogram)
+    requests = [lambda: generator.make_reservation(book_id, user_id)] * number_of_requests
+    results = await run(requests)
+    print(histogram(results))
 
 
-def stress_test_2(books, number_of_requests=10000, num_workers=4):
+async def stress_test_2(generator, run, books, number_of_requests=10000, num_workers=4):
     """
     num_workers clients make requests randomly (number_of_requests times)
     """
-    def run_worker(user_id):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(make_random_request, user_id, books) for _ in range(number_of_requests)]
-            results = [future.result() for future in futures]
-            # make a histogram of the results
-            # count number of occurrences of each result
-            histogram = {}
-            for result in results:
-                result = json.dumps(result)
-                if result in histogram:
-                    histogram[result] += 1
-                else:
-                    histogram[result] = 1
-            print(f"User {user_id} Histogram: {histogram}")
+    async def random_request(user_id):
+        return user_id, await generator.make_random_request(user_id, books)
 
-    # Start multiple workers with different user_ids
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        executor.map(run_worker, range(num_workers))
+    # Interleave the requests of all clients
+    requests = [lambda user_id=user_id: random_request(user_id) for _ in range(number_of_requests) for user_id in range(num_workers)]
+    results = await run(requests)
+    for user_id in range(num_workers):
+        print(f"User {user_id} Histogram: {histogram(result for worker, result in results if worker == user_id)}")
 
 
-def stress_test_3(books):
+async def stress_test_3(generator, books):
     """
     Immediate occupancy of all reservations by 2 clients
     """
-    def reserve_seats(user_id):
+    async def reserve_seats(user_id):
         success_histogram = {"Worker 1": 0, "Worker 2": 0}
         for book in books:
-            book_id = book["book_id"]
-            response = make_reservation(book_id, user_id)
+            response = await generator.make_reservation(book["book_id"], user_id)
             if "message" in response:
                 success_histogram[f"Worker {user_id}"] += 1
         print(f"Worker {user_id} Success Histogram: {success_histogram}")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        executor.map(reserve_seats, [1, 2])
+    await asyncio.gather(reserve_seats(1), reserve_seats(2))
 
 
-def stress_test_4(book_id, user_id, number_of_requests=5000):
+async def stress_test_4(generator, book_id, user_id, number_of_requests=5000):
     """
     Constant cancellations and book occupancy for the same book.
     """
-    def constant_operations():
+    async def constant_operations():
         success_histogram = {"make_reservation": 0, "remove_reservation": 0}
         for _ in range(number_of_requests):  # 5000 reservations and 5000 cancellations
-            make_response = make_reservation(book_id, user_id)
+            make_response = await generator.make_reservation(book_id, user_id)
             if "message" in make_response:
                 success_histogram["make_reservation"] += 1
 
-            remove_response = remove_reservation(book_id, user_id)
+            remove_response = await generator.remove_reservation(book_id, user_id)
             if "message" in remove_response:
                 success_histogram["remove_reservation"] += 1
-        
+
         print(f"User {user_id} Success Histogram: {success_histogram}")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        futures = [executor.submit(constant_operations) for _ in range(2)]
-        concurrent.futures.wait(futures)
+    await asyncio.gather(constant_operations(), constant_operations())
 
 
-def stress_test_5(books, user_id, num_workers=10):
+async def stress_test_5(generator, run, books, user_id):
     """
     Update reservations concurrently using multiple workers.
     """
-    def update_worker(worker_id, book_ids):
-        success_count = 0
-        for book_id in book_ids:
-            response = update_reservation(book_id, user_id)
-            if "message" in response:
-                success_count += 1
-        print(f"Worker {worker_id} updated {success_count} reservations successfully.")
+    # Initialize reservations, only the updates are measured
+    await create_initial_reservations(generator, books, user_id)
+    generator.recorder.reset()
 
-    # Initialize reservations
-    create_initial_reservations(books, user_id)
-    
     book_ids = [book["book_id"] for book in books]
-    book_chunks = [book_ids[i::num_workers] for i in range(num_workers)]
+    requests = [lambda book_id=book_id: generator.update_reservation(book_id, user_id) for book_id in book_ids]
+    results = await run(requests)
+    success_count = sum(1 for result in results if "message" in result)
+    print(f"Updated {success_count}/{len(book_ids)} reservations successfully.")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = [executor.submit(update_worker, worker_id, book_chunks[worker_id]) for worker_id in range(num_workers)]
-        concurrent.futures.wait(futures)
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report['duration_s']:.2f}s ({report['throughput_rps']:.1f} req/s)")
+    for endpoint, stats in sorted(report["endpoints"].items()):
+        print(f"  {endpoint}: {stats['requests']} requests, {stats['throughput_rps']:.1f} req/s, "
+              f"p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms, max {stats['max_ms']:.1f}ms")
+
+
+async def main(args, books):
+    random_book_id = uuid.UUID(books[2]["book_id"])
+    random_user_id = 132
+
+    # Test 5 keeps one request in flight per worker
+    concurrency = args.workers if args.test == 5 else args.concurrency
+    if args.mode == "open":
+        run = lambda requests: run_open(requests, args.rate)
+    else:
+        run = lambda requests: run_closed(requests, concurrency)
+
+    recorder = LatencyRecorder()
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        generator = LoadGenerator(session, args.url, recorder)
+        if args.test == 1:
+            await stress_test_1(generator, run, random_book_id, random_user_id, number_of_requests=args.size)
+        elif args.test == 2:
+            await stress_test_2(generator, run, books, number_of_requests=args.size, num_workers=args.workers)
+        elif args.test == 3:
+            await stress_test_3(generator, books[:args.size])
+        elif args.test == 4:
+            await stress_test_4(generator, random_book_id, random_user_id, number_of_requests=args.size)
+        elif args.test == 5:
+            await stress_test_5(generator, run, books[:args.size], random_user_id)
+    recorder.stop()
+
+    report = recorder.report()
+    report.update({"test": args.test, "mode": args.mode, "size": args.size, "workers": args.workers,
+                   "concurrency": concurrency, "rate": args.rate})
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -167,16 +282,4 @@ if __name__ == "__main__":
         reader = csv.DictReader(f)
         books = list(reader)
 
-    random_book_id = uuid.UUID(books[2]["book_id"])
-    random_user_id = 132
-
-    if args.test == 1:
-        stress_test_1(random_book_id, random_user_id, number_of_requests=args.size)
-    elif args.test == 2:
-        stress_test_2(books, number_of_requests=args.size, num_workers=args.workers)
-    elif args.test == 3:
-        stress_test_3(books[:args.size])
-    elif args.test == 4:
-        stress_test_4(random_book_id, random_user_id, number_of_requests=args.size)
-    elif args.test == 5:
-        stress_test_5(books[:args.size], random_user_id, num_workers=args.workers)
\ No newline at end of file
+    asyncio.run(main(args, books))
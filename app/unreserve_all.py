@@ -1,25 +1,32 @@
-import requests
+import sys
 import json
+import argparse
+import requests
 
 # Define the URL of the server
-base_url = "http://localhost:8888/remove_reservation"
+base_url = "http://localhost:8888/admin/reset"
 
 # Function to remove all reservations
-def remove_all_reservations():
-    # Assuming reservations are fetched from another endpoint
-    reservations_url = "http://localhost:8888/api/reservations"
-    reservations = requests.get(reservations_url).json()
-    counter = 0
-    total_reservations = len(reservations)
-    # Iterate through reservations and send POST request to remove each one
-    for reservation in reservations:
-        payload = {"book_id": reservation["book_id"], "user_id": reservation["user_id"]}
-        requests.post(base_url, data=json.dumps(payload))
-        counter += 1
-        if counter % 250 == 0:
-            total_reservations -= 250
-            print(f"{total_reservations} reservations remaining")
-            counter = 0
+def remove_all_reservations(truncate=False, concurrency=64):
+    # The server removes everything in parallel and streams its progress
+    payload = {"truncate": truncate, "concurrency": concurrency}
+    with requests.post(base_url, data=json.dumps(payload), stream=True) as response:
+        if response.status_code == 403:
+            sys.exit(f"The server refused to reset: {response.json().get('error')} Set ALLOW_ADMIN_RESET=1 (and ALLOW_TRUNCATE=1 for --truncate) on the server.")
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            progress = json.loads(line)
+            if progress.get("truncated"):
+                print(f"{progress['table']}: truncated")
+            else:
+                print(f"{progress['table']}: {progress['partitions_deleted']} partitions deleted")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove all reservations and book locks (the server must set ALLOW_ADMIN_RESET).")
+    parser.add_argument("--truncate", action="store_true", help="Truncate the tables instead of deleting partitions (the server must set ALLOW_TRUNCATE).")
+    parser.add_argument("--concurrency", type=int, default=64, help="Number of partitions deleted in parallel (default: 64)")
+    args = parser.parse_args()
 
-# Call the function to remove all reservations
-remove_all_reservations()
+    remove_all_reservations(args.truncate, args.concurrency)